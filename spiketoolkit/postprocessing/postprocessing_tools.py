@@ -782,7 +782,7 @@ def export_to_phy(recording, sorting, output_folder, n_comp=3, electrode_dimensi
 
     # save dat file
     if dtype is None:
-        dtype = recording.get_traces(channel_ids=[recording.get_channel_ids()[0]], start_frame=0, end_frame=1).dtype
+        dtype = recording.get_dtype()
 
     if isinstance(recording, se.BinDatRecordingExtractor):
         if recording._time_axis == 0:
@@ -1128,12 +1128,13 @@ def _get_phy_data(recording, sorting, n_comp, electrode_dimensions, grouping_pro
         templates_ind = np.zeros((len(sorting.get_unit_ids()), int(max_num_chans_in_group)), dtype=int)
         templates_red = np.zeros((templates.shape[0], templates.shape[1], int(max_num_chans_in_group)))
 
+        channel_map_si_index = {ch: i for i, ch in enumerate(channel_map_si)}
         for u_i, u in enumerate(sorting.get_unit_ids()):
             group = sorting.get_unit_property(u, 'group')
             unit_chans = []
             for ch in recording.get_channel_ids():
                 if recording.get_channel_property(ch, 'group') == group:
-                    unit_chans.append(list(channel_map_si).index(ch))
+                    unit_chans.append(channel_map_si_index[ch])
             if len(unit_chans) == 0:
                 raise Exception("Sorting extractor has different property than recording extractor. "
                                 "They should correspond.")
@@ -1 +1,6 @@
 from .preprocessinglist import *
+from .basepreprocessorrecording import BasePreprocessorRecording
+from .filterrecording import FilteredChunkCache, get_global_chunk_cache, set_chunk_cache_memory
+from .pipeline import pipeline, Pipeline
+from .preprocessing_tools import get_recording_fingerprint, get_cache_folder, set_cache_folder, RecordingStatistics, \
+    get_recording_statistics
@@ -1,10 +1,15 @@
-from .filterrecording import FilterRecording
+from .filterrecording import FilterRecording, _get_sos_padding
+from collections import OrderedDict
 import numpy as np
 from scipy import special
 import spikeextractors as se
 
+# number of rfft-domain kernels kept by each extractor (one per padded window length)
+_max_kernels = 4
+
 try:
     import scipy.signal as ss
+    import scipy.fft as sfft
     HAVE_BFR = True
 except ImportError:
     HAVE_BFR = False
@@ -25,73 +30,114 @@ class BandpassFilterRecording(FilterRecording):
             "Chunk size for the filter."},
         {'name': 'cache_chunks', 'type': 'bool', 'value': False, 'default': False, 'title':
             "If True fileterd chunk traces are computed and cached in memory"},
+        {'name': 'workers', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of threads used by scipy.fft (when type is 'fft')"},
+        {'name': 'compute_dtype', 'type': 'dtype', 'value': 'float64', 'default': 'float64', 'title':
+            "Dtype used for the filter computation ('float32' or 'float64')"},
+        {'name': 'causal', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True the filter is applied causally with a carried state (only if 'butter')"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of parallel jobs used to filter the chunks of a get_traces call"},
+        {'name': 'backend', 'type': 'str', 'value': 'thread', 'default': 'thread', 'title':
+            "Parallel backend for the chunks ('thread' or 'process')"},
+        {'name': 'read_ahead', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True the next chunk is filtered in a background thread during sequential reads"},
+        {'name': 'padding', 'type': 'int', 'value': None, 'default': None, 'title':
+            "Padding (in frames) on each side of the chunks. If None it is derived from padding_tol"},
+        {'name': 'padding_tol', 'type': 'float', 'value': 1e-5, 'default': 1e-5, 'title':
+            "Relative amplitude of the impulse response below which it is truncated to derive the padding"},
     ]
     installation_mesg = "To use the BandpassFilterRecording, install scipy: \n\n pip install scipy\n\n"  # err
 
     def __init__(self, recording, freq_min=300, freq_max=6000, freq_wid=1000, type='fft', order=3,
-                 chunk_size=30000, cache_chunks=False):
+                 chunk_size=30000, cache_chunks=False, n_jobs=1, backend='thread', workers=1,
+                 compute_dtype='float64', causal=False, read_ahead=False, padding=None, padding_tol=1e-5):
         assert HAVE_BFR, "To use the BandpassFilterRecording, install scipy: \n\n pip install scipy\n\n"
+        if np.dtype(compute_dtype) not in [np.dtype('float32'), np.dtype('float64')]:
+            raise ValueError("'compute_dtype' must be 'float32' or 'float64'")
+        if causal and type != 'butter':
+            raise ValueError("'causal' filtering is only available for the 'butter' type")
         self._freq_min = freq_min
         self._freq_max = freq_max
         self._freq_wid = freq_wid
         self._type = type
         self._order = order
         self._chunk_size = chunk_size
+        self._workers = workers
+        self._causal = causal
+        self._compute_dtype = np.dtype(compute_dtype)
+        # rfft-domain kernels by padded chunk length, least recently used first
+        self._kernels = OrderedDict()
 
         if self._type == 'butter':
             fn = recording.get_sampling_frequency() / 2.
             band = np.array([self._freq_min, self._freq_max]) / fn
 
-            self._b, self._a = ss.butter(self._order, band, btype='bandpass')
+            self._sos = ss.butter(self._order, band, btype='bandpass', output='sos')
 
-            if not np.all(np.abs(np.roots(self._a)) < 1):
+            if not np.all(np.abs(ss.sos2zpk(self._sos)[1]) < 1):
                 raise ValueError('Filter is not stable')
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
+            self._padding = _get_sos_padding(self._sos, tol=padding_tol)
+            self._sos = self._sos.astype(self._compute_dtype)
+        else:
+            self._padding = 3000
+        if padding is not None:
+            self._padding = padding
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 n_jobs=n_jobs, backend=backend,
+                                 read_ahead=read_ahead)
         self.copy_channel_properties(recording)
 
-    def filter_chunk(self, *, start_frame, end_frame):
-        padding = 3000
-        i1 = start_frame - padding
-        i2 = end_frame + padding
-        padded_chunk = self._read_chunk(i1, i2)
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        if self._causal:
+            return self._filter_causal_chunk(start_frame, end_frame, channel_ids)
+        i1 = start_frame - self._padding
+        i2 = end_frame + self._padding
+        padded_chunk = self._read_chunk(i1, i2, channel_ids=channel_ids, dtype=self._compute_dtype)
         filtered_padded_chunk = self._do_filter(padded_chunk)
         return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
 
+    def _get_pipeline_margin(self):
+        return self._padding
+
+    def _process_pipeline_chunk(self, traces, start_frame, margin):
+        return self._do_filter(traces)
+
     def _do_filter(self, chunk):
-        sampling_frequency = self._recording.get_sampling_frequency()
-        M = chunk.shape[0]
-        chunk2 = chunk
         # Do the actual filtering with a DFT with real input
         if self._type == 'fft':
-            chunk_fft = np.fft.rfft(chunk2)
-            kernel = _create_filter_kernel(
-                chunk2.shape[1],
-                sampling_frequency,
-                self._freq_min, self._freq_max, self._freq_wid
-            )
-            kernel = kernel[0:chunk_fft.shape[1]]  # because this is the DFT of real data
-            chunk_fft = chunk_fft * np.tile(kernel, (M, 1))
-            chunk_filtered = np.fft.irfft(chunk_fft)
+            chunk_fft = sfft.rfft(chunk, axis=1, workers=self._workers)
+            chunk_fft *= self._get_kernel(chunk.shape[1])
+            chunk_filtered = sfft.irfft(chunk_fft, n=chunk.shape[1], axis=1, workers=self._workers)
         elif self._type == 'butter':
-            chunk_filtered = ss.filtfilt(self._b, self._a, chunk2, axis=1)
+            chunk_filtered = ss.sosfiltfilt(self._sos, chunk, axis=1)
 
         return chunk_filtered
 
-    def _read_chunk(self, i1, i2):
-        M = len(self._recording.get_channel_ids())
-        N = self._recording.get_num_frames()
-        if i1 < 0:
-            i1b = 0
-        else:
-            i1b = i1
-        if i2 > N:
-            i2b = N
+    def _get_kernel(self, N):
+        kernel = self._kernels.get(N)
+        if kernel is not None:
+            try:
+                self._kernels.move_to_end(N)
+            except KeyError:
+                # evicted by a concurrent call
+                pass
         else:
-            i2b = i2
-        ret = np.zeros((M, i2 - i1))
-        ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b)
-
-        return ret
+            kernel = _create_filter_kernel(
+                N,
+                self._recording.get_sampling_frequency(),
+                self._freq_min, self._freq_max, self._freq_wid
+            )
+            kernel = kernel[0:N // 2 + 1]  # because this is the DFT of real data
+            kernel = kernel.astype(self._compute_dtype)
+            self._kernels[N] = kernel
+            # windows of many lengths (e.g. with chunk_size=None) must not grow the cache without limit
+            while len(self._kernels) > _max_kernels:
+                try:
+                    self._kernels.popitem(last=False)
+                except KeyError:
+                    break
+        return kernel
 
 
 def _create_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid=1000):
@@ -118,7 +164,8 @@ def _create_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid=10
 
 
 def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, type='fft', order=3,
-                    chunk_size=30000, cache_to_file=False, cache_chunks=False):
+                    chunk_size=30000, cache_to_file=False, cache_chunks=False, n_jobs=1, backend='thread', workers=1,
+                    compute_dtype='float64', causal=False, read_ahead=False, padding=None, padding_tol=1e-5):
     '''
     Performs a lazy filter on the recording extractor traces.
 
@@ -134,15 +181,41 @@ def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, type=
         Width of the filter (when type is 'fft').
     type: str
         'fft' or 'butter'. The 'fft' filter uses a kernel in the frequency domain. The 'butter' filter uses
-        scipy butter and filtfilt functions.
+        scipy butter and sosfiltfilt functions (second-order sections), with a padding derived from the decay
+        of the filter impulse response.
     order: int
         Order of the filter (if 'butter').
     chunk_size: int
         The chunk size to be used for the filtering.
     cache_to_file: bool (default False).
         If True, filtered traces are computed and cached all at once on disk in temp file 
-    cache_chunks: bool (default False).
-        If True then each chunk is cached in memory (in a dict)
+    cache_chunks: bool, 'global', or FilteredChunkCache (default False).
+        If True then each chunk is cached in memory (in a LRU cache with the default memory budget).
+        If 'global' the process-wide chunk cache is used. A FilteredChunkCache can be passed to share
+        the same cache (and memory budget) among several extractors, or to set its budget and on-disk tier.
+    n_jobs: int
+        Number of jobs used to filter in parallel the chunks spanned by a get_traces call (default 1).
+    backend: str
+        'thread' or 'process'. Pool used when n_jobs is not 1 (default 'thread').
+    read_ahead: bool
+        If True, while a chunk is consumed the next one is filtered in a background thread, so that sequential
+        reads (e.g. writing to a binary file) overlap reading and filtering (default False).
+    workers: int
+        Number of threads used by scipy.fft when type is 'fft' (default 1).
+    compute_dtype: str
+        'float64' or 'float32'. Dtype of the padded chunks during filtering. 'float32' halves the memory
+        and speeds up the FFT and the second-order sections (default 'float64').
+    causal: bool
+        If True (only for 'butter'), the filter is applied forward only with sosfilt, carrying the filter state
+        from one chunk to the next, instead of sosfiltfilt. Sequential reads need no padding and
+        filter_recording.stream() yields filtered blocks while the recording grows (default False).
+    padding: int or None
+        Number of frames read on each side of a chunk. If None, it is 3000 for 'fft', and for 'butter' the length
+        after which the impulse response decays below padding_tol times its peak (default None).
+    padding_tol: float
+        Relative amplitude below which the impulse response of the 'butter' filter is truncated to derive the
+        padding (default 1e-5). A larger tolerance (or an explicit padding) reads fewer frames per chunk, at the
+        cost of a filtering error of the order of the tolerance near the chunk edges.
     Returns
     -------
     filter_recording: BandpassFilterRecording
@@ -160,6 +233,14 @@ def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, type=
         order=order,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
+        n_jobs=n_jobs,
+        backend=backend,
+        workers=workers,
+        compute_dtype=compute_dtype,
+        causal=causal,
+        read_ahead=read_ahead,
+        padding=padding,
+        padding_tol=padding_tol,
     )
     if cache_to_file:
         return se.CacheRecordingExtractor(bpf_recording, chunk_size=chunk_size)
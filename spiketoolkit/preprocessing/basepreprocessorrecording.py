@@ -0,0 +1,59 @@
+from spikeextractors import RecordingExtractor
+
+
+class BasePreprocessorRecording(RecordingExtractor):
+    '''
+    Base class of the preprocessing recording extractors. The metadata of the recording (channel ids, channel index
+    map, number of frames, sampling frequency, and dtype) are computed once, so that short reads through deep chains
+    of preprocessors do not query every level of the chain at each call. If the underlying recording changes (e.g.
+    it grows while streaming), refresh_metadata() clears the cached metadata of the whole chain.
+    '''
+
+    def __init__(self):
+        self._metadata = {}
+        RecordingExtractor.__init__(self)
+
+    def get_channel_ids(self):
+        # a copy, so that the cached list is not modified by the caller
+        return list(self._get_metadata('channel_ids', lambda: list(self._recording.get_channel_ids())))
+
+    def get_num_frames(self):
+        return self._get_metadata('num_frames', self._recording.get_num_frames)
+
+    def get_sampling_frequency(self):
+        return self._get_metadata('sampling_frequency', self._recording.get_sampling_frequency)
+
+    def get_dtype(self):
+        return self._get_metadata('dtype', lambda: RecordingExtractor.get_dtype(self))
+
+    def get_channel_index(self):
+        '''
+        Returns a dictionary with the index of each channel id in get_channel_ids()
+        '''
+        return self._get_metadata('channel_index',
+                                  lambda: {chan: i for i, chan in enumerate(self.get_channel_ids())})
+
+    def refresh_metadata(self):
+        '''
+        Clears the cached metadata of this recording extractor and of the preprocessors it is applied on.
+        '''
+        self._metadata = {}
+        parent = getattr(self, '_recording', None)
+        if hasattr(parent, 'refresh_metadata'):
+            parent.refresh_metadata()
+
+    def _get_input_num_frames(self):
+        # number of frames of the recording the preprocessor is applied on
+        return self._get_metadata('input_num_frames', self._recording.get_num_frames)
+
+    def _get_metadata(self, key, compute):
+        if key not in self._metadata:
+            self._metadata[key] = compute()
+        return self._metadata[key]
+
+
+def _get_channel_index(recording):
+    # index of each channel id, shared by the preprocessors and built for other recording extractors
+    if isinstance(recording, BasePreprocessorRecording):
+        return recording.get_channel_index()
+    return {chan: i for i, chan in enumerate(recording.get_channel_ids())}
@@ -1,8 +1,8 @@
-from spikeextractors import RecordingExtractor
+from .elementwise import ElementwiseRecording
 import numpy as np
 
 
-class ClipTracesRecording(RecordingExtractor):
+class ClipTracesRecording(ElementwiseRecording):
     preprocessor_name = 'ClipTraces'
     installed = True  # check at class level if installed or not
     preprocessor_gui_params = [
@@ -14,38 +14,15 @@ class ClipTracesRecording(RecordingExtractor):
     installation_mesg = ""  # err
 
     def __init__(self, recording, a_min=None, a_max=None):
-        if not isinstance(recording, RecordingExtractor):
-            raise ValueError("'recording' must be a RecordingExtractor")
-        self._recording = recording
         self._a_min = a_min
         self._a_max = a_max
-        RecordingExtractor.__init__(self)
-        self.copy_channel_properties(recording=self._recording)
+        ElementwiseRecording.__init__(self, recording)
 
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
-
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = self.get_num_frames()
-        if channel_ids is None:
-            channel_ids = self.get_channel_ids()
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame)
-        if self._a_min is not None:
-            traces[traces < self._a_min] = self._a_min
-        if self._a_max is not None:
-            traces[traces > self._a_max] = self._a_max
-        return traces
+    def _apply(self, traces):
+        if self._a_min is None and self._a_max is None:
+            return traces
+        # the bounds may be floats while the traces are integers: they are clipped in place in the traces dtype
+        return np.clip(traces, self._a_min, self._a_max, out=traces, casting='unsafe')
 
 
 def clip_traces(recording, a_min=None, a_max=None):
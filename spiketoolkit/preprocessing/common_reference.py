@@ -1,30 +1,42 @@
 from spikeextractors import RecordingExtractor
+from .basepreprocessorrecording import BasePreprocessorRecording
 import numpy as np
+from joblib import Parallel, delayed
 
+# memory budget of the neighbor traces gathered at once by the local reference
+_local_block_bytes = 64 * 1024 ** 2
 
-class CommonReferenceRecording(RecordingExtractor):
+
+class CommonReferenceRecording(BasePreprocessorRecording):
     preprocessor_name = 'CommonReference'
     installed = True  # check at class level if installed or not
     preprocessor_gui_params = [
         {'name': 'reference', 'type': 'str', 'value': 'median', 'default': 'median',
-         'title': "Reference type ('median', 'average', or 'single')"},
+         'title': "Reference type ('median', 'average', 'single', or 'local')"},
         {'name': 'groups', 'type': 'int_list_list', 'value': None, 'default': None, 'title': "List of int lists containins the channels for splitting the reference, \
         The CMR, CAR, or referencing with respect to single channels are applied group-wise. It is useful when dealing with different channel groups, e.g. multiple tetrodes."},
         {'name': 'ref_channels', 'type': 'int_list', 'value': None, 'default': None, 'title': "If no 'groups' are specified, all channels are referenced to 'ref_channels'. \
          If 'groups' is provided, then a list of channels to be applied to each group is expected. If 'single' reference, a list of one channel is expected."},
+        {'name': 'local_radius', 'type': 'float_list', 'value': [30, 55], 'default': [30, 55],
+         'title': "Inner and outer radius (in the units of the channel locations) of the annulus of channels used by "
+                  "the 'local' reference"},
         {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None,
          'title': "Traces dtype. If None, dtype is maintained."},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1,
+         'title': "Number of threads used to reference the groups of a get_traces call"},
         {'name': 'verbose', 'type': 'bool', 'value': False, 'default': False,
          'title': "If True, then the function will be verbose"}
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, reference='median', groups=None, ref_channels=None, dtype=None, verbose=False):
+    def __init__(self, recording, reference='median', groups=None, ref_channels=None, dtype=None, n_jobs=1,
+                 verbose=False, local_radius=(30, 55)):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
-        if reference != 'median' and reference != 'average' and reference != 'single':
-            raise ValueError("'reference' must be either 'median' or 'average'")
+        if reference not in ['median', 'average', 'single', 'local']:
+            raise ValueError("'reference' must be 'median', 'average', 'single', or 'local'")
         self._recording = recording
+        BasePreprocessorRecording.__init__(self)
         self._ref = reference
         self._groups = groups
         if self._ref == 'single':
@@ -39,22 +51,115 @@ class CommonReferenceRecording(RecordingExtractor):
                     assert isinstance(ref_channels, (int, np.integer)), "'ref_channels' must be int"
                     ref_channels = [ref_channels]
         self._ref_channel = ref_channels
+        self._n_jobs = n_jobs
+        # row indices of the groups and reference channels in the parent traces, computed once. Without groups,
+        # all channels form a single group
+        channel_ids = self.get_channel_ids()
+        channel_index = self.get_channel_index()
+        if self._groups is not None:
+            self._group_indices = [np.array([channel_index[chan] for chan in g if chan in channel_index],
+                                            dtype=int) for g in self._groups]
+        else:
+            self._group_indices = [np.arange(len(channel_ids))]
+        # group of each parent row (-1 for channels that are not in any group and are not referenced)
+        self._row_groups = -np.ones(len(channel_ids), dtype=int)
+        for i, idx in enumerate(self._group_indices):
+            self._row_groups[idx] = i
+        if self._ref == 'single':
+            self._ref_indices = [channel_index[chan] for chan in self._ref_channel]
+        self._local_radius = local_radius
+        if self._ref == 'local':
+            self._neighbors, self._num_neighbors = self._compute_local_neighbors()
         if dtype is None:
             self._dtype = recording.get_dtype()
         else:
             self._dtype = dtype
         self.verbose = verbose
-        RecordingExtractor.__init__(self)
         self.copy_channel_properties(recording=self._recording)
 
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
+    def _compute_local_neighbors(self):
+        # sparse neighbor table: row i of the table holds the num_neighbors[i] channels (parent rows) in the
+        # annulus around channel i, padded with -1. Channels are only neighbors within the same group
+        try:
+            locations = np.array(self._recording.get_channel_locations(), dtype='float64')
+        except Exception:
+            raise ValueError("The 'local' reference needs the 'location' property of the channels")
+        if len(self._local_radius) != 2 or self._local_radius[0] > self._local_radius[1]:
+            raise ValueError("'local_radius' must be (inner radius, outer radius)")
+        inner, outer = self._local_radius
+        neighbors = []
+        for i in range(locations.shape[0]):
+            dist = np.linalg.norm(locations - locations[i], axis=1)
+            mask = (dist >= inner) & (dist <= outer) & (self._row_groups == self._row_groups[i])
+            mask[i] = False
+            if self._row_groups[i] < 0:
+                mask[:] = False
+            neighbors.append(np.nonzero(mask)[0])
+        num_neighbors = np.array([len(n) for n in neighbors], dtype=int)
+        table = -np.ones((len(neighbors), max(np.max(num_neighbors), 1)), dtype=int)
+        for i, n in enumerate(neighbors):
+            table[i, :len(n)] = n
+        return table, num_neighbors
+
+    def _local_reference(self, traces, out_rows, out, rows=None):
+        # out[j] = traces[out_rows[j]] - median of the neighbors of channel out_rows[j]. out_rows are parent rows,
+        # mapped to rows of traces by rows (None if identical). The channels are processed by number of
+        # neighbors, so that the cost per sample scales with the neighborhood size
+        num_neighbors = self._num_neighbors[out_rows]
+        for k in np.unique(num_neighbors):
+            out_idx = np.nonzero(num_neighbors == k)[0]
+            chan_idx = out_rows[out_idx]
+            table = self._neighbors[chan_idx, :k]
+            if rows is not None:
+                chan_idx = rows[chan_idx]
+                table = rows[table]
+            if k == 0:
+                # channels without neighbors are not referenced
+                out[out_idx] = traces[chan_idx]
+                continue
+            block = max(1, int(_local_block_bytes / (table.size * traces.itemsize)))
+            for t1 in range(0, traces.shape[1], block):
+                t2 = min(t1 + block, traces.shape[1])
+                out[out_idx, t1:t2] = traces[chan_idx, t1:t2] - np.median(traces[table, t1:t2], axis=1)
+        return out
 
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
+    def _get_pipeline_margin(self):
+        return 0
 
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
+    def _process_pipeline_chunk(self, traces, start_frame, margin):
+        return self._reference(traces)
+
+    def _get_group_reference(self, traces, group, rows=None):
+        # reference (1 x frames) of the given group. rows maps parent rows to rows of traces (None if identical)
+        if self._ref == 'single':
+            ref_row = self._ref_indices[group]
+            if rows is not None:
+                ref_row = rows[ref_row]
+            return traces[ref_row:ref_row + 1].copy()
+        idx = self._group_indices[group]
+        if rows is not None:
+            idx = rows[idx]
+        if len(idx) == traces.shape[0]:
+            # a single group with all channels: no copy
+            group_traces = traces
+        else:
+            group_traces = traces[idx]
+        if self._ref == 'median':
+            return np.median(group_traces, axis=0, keepdims=True)
+        else:
+            return np.mean(group_traces, axis=0, keepdims=True)
+
+    def _reference(self, traces):
+        # references in place traces containing all the channels of the parent recording
+        if self._ref == 'local':
+            return self._local_reference(traces, np.arange(traces.shape[0]), np.empty_like(traces))
+        for group, idx in enumerate(self._group_indices):
+            ref = self._get_group_reference(traces, group)
+            if len(idx) == traces.shape[0]:
+                traces -= ref
+            else:
+                traces[idx] -= ref
+        return traces
 
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
         if start_frame is None:
@@ -65,82 +170,59 @@ class CommonReferenceRecording(RecordingExtractor):
             channel_ids = self.get_channel_ids()
         if isinstance(channel_ids, (int, np.integer)):
             channel_ids = [channel_ids]
-        if self._ref == 'median':
+        if self.verbose:
             if self._groups is None:
-                if self.verbose:
-                    print('Common median reference using all channels')
-                traces = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-                traces = traces - np.median(traces, axis=0, keepdims=True)
-                return traces[channel_ids].astype(self._dtype)
+                print(f"Common {self._ref} reference using all channels")
             else:
-                new_groups = []
-                for g in self._groups:
-                    new_chans = []
-                    for chan in g:
-                        if chan in self._recording.get_channel_ids():
-                            new_chans.append(chan)
-                    new_groups.append(new_chans)
-                if self.verbose:
-                    print('Common median in groups: ', new_groups)
-                traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_group,
-                                                                        start_frame=start_frame, end_frame=end_frame)
-                                             - np.median(self._recording.get_traces(channel_ids=split_group,
-                                                                                    start_frame=start_frame,
-                                                                                    end_frame=end_frame),
-                                                         axis=0, keepdims=True) for split_group in new_groups]))
-                return traces[channel_ids].astype(self._dtype)
-        elif self._ref == 'average':
-            if self.verbose:
-                print('Common average reference using all channels')
-            if self._groups is None:
-                traces = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-                traces = traces - np.mean(traces, axis=0, keepdims=True)
-                return traces[channel_ids].astype(self._dtype)
-            else:
-                new_groups = []
-                for g in self._groups:
-                    new_chans = []
-                    for chan in g:
-                        if chan in self._recording.get_channel_ids():
-                            new_chans.append(chan)
-                    new_groups.append(new_chans)
-                if self.verbose:
-                    print('Common average in groups: ', new_groups)
-                traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_group,
-                                                                        start_frame=start_frame, end_frame=end_frame)
-                                             - np.mean(self._recording.get_traces(channel_ids=split_group,
-                                                                                  start_frame=start_frame,
-                                                                                  end_frame=end_frame),
-                                                       axis=0, keepdims=True) for split_group in new_groups]))
-                return traces[channel_ids].astype(self._dtype)
-        elif self._ref == 'single':
-            if self._groups is None:
-                if self.verbose:
-                    print('Reference to channel', self._ref_channel)
-                traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame,
-                                                    end_frame=end_frame) \
-                         - self._recording.get_traces(channel_ids=self._ref_channel, start_frame=start_frame,
-                                                      end_frame=end_frame)
-                return traces.astype(self._dtype)
-            else:
-                new_groups = []
-                for g in self._groups:
-                    new_chans = []
-                    for chan in g:
-                        if chan in self._recording.get_channel_ids():
-                            new_chans.append(chan)
-                    new_groups.append(new_chans)
-                if self.verbose:
-                    print('Reference', new_groups, 'to channels', self._ref_channel)
-                traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_group,
-                                                                      start_frame=start_frame, end_frame=end_frame)
-                                           - self._recording.get_traces(channel_ids=[ref], start_frame=start_frame,
-                                                                        end_frame=end_frame)
-                                           for (split_group, ref) in zip(new_groups, self._ref_channel)]))
-                return traces.astype(self._dtype)
-
-
-def common_reference(recording, reference='median', groups=None, ref_channels=None, dtype=None, verbose=False):
+                print(f"Common {self._ref} reference in groups: ", self._groups)
+        channel_index = self.get_channel_index()
+        out_rows = np.array([channel_index[chan] for chan in channel_ids], dtype=int)
+        out_groups = self._row_groups[out_rows]
+        groups = [g for g in np.unique(out_groups) if g >= 0]
+
+        # the parent is read once, with the requested channels and the channels needed for their references
+        needed = [out_rows]
+        if self._ref == 'local':
+            neighbors = self._neighbors[out_rows]
+            needed.append(neighbors[neighbors >= 0])
+        else:
+            for g in groups:
+                if self._ref == 'single':
+                    needed.append([self._ref_indices[g]])
+                else:
+                    needed.append(self._group_indices[g])
+        needed = np.unique(np.concatenate(needed))
+        parent_ids = self.get_channel_ids()
+        traces = self._recording.get_traces(channel_ids=[parent_ids[i] for i in needed], start_frame=start_frame,
+                                            end_frame=end_frame)
+        if not np.issubdtype(traces.dtype, np.floating):
+            traces = traces.astype('float64')
+        # position in traces of each parent row
+        rows = -np.ones(len(parent_ids), dtype=int)
+        rows[needed] = np.arange(len(needed))
+
+        out = np.empty((len(channel_ids), traces.shape[1]), dtype=self._dtype)
+        if self._ref == 'local':
+            return self._local_reference(traces, out_rows, out, rows)
+        not_referenced = np.nonzero(out_groups < 0)[0]
+        if len(not_referenced) > 0:
+            out[not_referenced] = traces[rows[out_rows[not_referenced]]]
+
+        def _reference_group(g):
+            out_idx = np.nonzero(out_groups == g)[0]
+            out[out_idx] = traces[rows[out_rows[out_idx]]] - self._get_group_reference(traces, g, rows)
+
+        if self._n_jobs == 1 or len(groups) == 1:
+            for g in groups:
+                _reference_group(g)
+        else:
+            # each group writes its own rows of the output
+            Parallel(n_jobs=self._n_jobs, prefer='threads')(delayed(_reference_group)(g) for g in groups)
+        return out
+
+
+def common_reference(recording, reference='median', groups=None, ref_channels=None, dtype=None, n_jobs=1,
+                     verbose=False, local_radius=(30, 55)):
     '''
     Re-references the recording extractor traces.
 
@@ -155,6 +237,10 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
         If 'average', common average reference (CAR) is implemented (the mean of the selected channels is removed
         for each timestamp).
         If 'single', the selected channel(s) is remove from all channels.
+        If 'local', the median of the channels in an annulus around each channel (see 'local_radius') is removed
+        from it. The neighbors are computed once from the 'location' property of the channels, so that the cost
+        scales with the number of neighbors instead of the number of channels. With 'groups', neighbors are
+        taken within the same group. Channels with no neighbors are not referenced.
     groups: list
         List of lists containins the channels for splitting the reference. The CMR, CAR, or referencing with respect to
         single channels are applied group-wise. It is useful when dealing with different channel groups, e.g. multiple
@@ -165,6 +251,12 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
         int is expected.
     dtype: str
         dtype of the returned traces. If None, dtype is maintained
+    n_jobs: int
+        Number of threads used to compute the references of the groups in parallel (default 1)
+    local_radius: tuple
+        Inner and outer radius of the annulus of neighbor channels for the 'local' reference, in the units of the
+        channel locations (default (30, 55)). The inner radius excludes the channels closest to each channel, which
+        share most of its spikes.
     verbose: bool
         If True, output is verbose
 
@@ -174,5 +266,6 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
         The re-referenced recording extractor object
     '''
     return CommonReferenceRecording(
-        recording=recording, reference=reference, groups=groups, ref_channels=ref_channels, dtype=dtype, verbose=verbose
+        recording=recording, reference=reference, groups=groups, ref_channels=ref_channels, dtype=dtype,
+        n_jobs=n_jobs, verbose=verbose, local_radius=local_radius
     )
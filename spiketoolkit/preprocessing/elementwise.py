@@ -0,0 +1,57 @@
+from abc import abstractmethod
+from spikeextractors import RecordingExtractor
+from .basepreprocessorrecording import BasePreprocessorRecording
+
+
+class ElementwiseRecording(BasePreprocessorRecording):
+    '''
+    Base class of the preprocessors applying an elementwise operation to the traces (e.g. transform, clip, rectify).
+
+    Stacked elementwise preprocessors are folded into a single chain of operations: get_traces reads the first
+    non-elementwise recording once and applies all the operations in place on the same buffer.
+    '''
+
+    def __init__(self, recording):
+        if not isinstance(recording, RecordingExtractor):
+            raise ValueError("'recording' must be a RecordingExtractor")
+        self._recording = recording
+        if isinstance(recording, ElementwiseRecording):
+            self._source = recording._source
+            self._operations = recording._operations + [self]
+        else:
+            self._source = recording
+            self._operations = [self]
+        BasePreprocessorRecording.__init__(self)
+        self.copy_channel_properties(recording=self._recording)
+
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        traces = self._source.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
+        # a single buffer, in the output dtype of the chain, is processed in place by all the operations
+        dtype = traces.dtype
+        for operation in self._operations:
+            dtype = operation._get_output_dtype(dtype)
+        if traces.dtype != dtype or not traces.flags.writeable:
+            traces = traces.astype(dtype)
+        for operation in self._operations:
+            traces = operation._apply(traces)
+        return traces
+
+    def _get_output_dtype(self, dtype):
+        return dtype
+
+    @abstractmethod
+    def _apply(self, traces):
+        # applies the operation in place and returns traces
+        raise NotImplementedError('_apply not implemented')
+
+    def _get_pipeline_margin(self):
+        return 0
+
+    def _process_pipeline_chunk(self, traces, start_frame, margin):
+        return self._apply(traces)
@@ -1,33 +1,55 @@
 from abc import ABC, abstractmethod
-import spikeextractors as se
+import threading
+import time
+import tempfile
+import weakref
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from spikeextractors import RecordingExtractor
+from joblib import Parallel, delayed
+from .basepreprocessorrecording import BasePreprocessorRecording
 
+# in causal mode, filter states are kept at every this many chunks for random access
+_causal_checkpoint_chunks = 10
 
-class FilterRecording(RecordingExtractor):
-    def __init__(self, recording, chunk_size=10000, cache_chunks=False):
+
+class FilterRecording(BasePreprocessorRecording):
+    _causal = False
+
+    def __init__(self, recording, chunk_size=10000, cache_chunks=False, n_jobs=1, backend='thread',
+                 read_ahead=False):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
+        if backend not in ['thread', 'process']:
+            raise ValueError("'backend' must be either 'thread' or 'process'")
         self._recording = recording
         self._chunk_size = chunk_size
         self._cache_chunks = cache_chunks
-        if cache_chunks:
+        self._n_jobs = n_jobs
+        self._backend = backend
+        if isinstance(cache_chunks, FilteredChunkCache):
+            self._filtered_cache_chunks = cache_chunks
+        elif cache_chunks == 'global':
+            self._filtered_cache_chunks = get_global_chunk_cache()
+        elif cache_chunks:
             self._filtered_cache_chunks = FilteredChunkCache()
         else:
             self._filtered_cache_chunks = None
         self._traces = None
-        se.RecordingExtractor.__init__(self)
+        # filter states (zi) by frame for the causal mode
+        self._causal_states = {}
+        self._causal_last_state = None
+        self._causal_lock = threading.Lock()
+        # background filtering of the chunk following the last one read
+        self._read_ahead = read_ahead
+        self._read_ahead_executor = None
+        self._read_ahead_job = None
+        self._read_ahead_lock = threading.Lock()
+        BasePreprocessorRecording.__init__(self)
         self.copy_channel_properties(recording)
 
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
-
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
         if start_frame is None:
             start_frame = 0
@@ -37,14 +59,24 @@ class FilterRecording(RecordingExtractor):
             channel_ids = self.get_channel_ids()
         if isinstance(channel_ids, (int, np.integer)):
             channel_ids = [channel_ids]
+        channel_index = self.get_channel_index()
+        if self._filtered_cache_chunks is not None or len(channel_ids) == len(channel_index):
+            # cached chunks contain all the channels
+            chunk_channel_ids = None
+            chan_idx = [channel_index[chan] for chan in channel_ids]
+        else:
+            # only the requested channels are read and filtered
+            chunk_channel_ids = channel_ids
+            chan_idx = slice(None)
         if self._chunk_size is not None:
             ich1 = int(start_frame / self._chunk_size)
             ich2 = int((end_frame - 1) / self._chunk_size)
-            dt = self._recording.get_traces(start_frame=0, end_frame=1).dtype
+            dt = self._get_filtered_dtype()
             filtered_chunk = np.zeros((len(channel_ids), int(end_frame-start_frame)), dtype=dt)
+            # (chunk index, start and end within the chunk, position in the output) for each chunk
+            chunk_slices = []
             pos = 0
             for ich in range(ich1, ich2 + 1):
-                filtered_chunk0 = self._get_filtered_chunk(ich)
                 if ich == ich1:
                     start0 = start_frame - ich * self._chunk_size
                 else:
@@ -53,57 +85,518 @@ class FilterRecording(RecordingExtractor):
                     end0 = end_frame - ich * self._chunk_size
                 else:
                     end0 = self._chunk_size
-                chan_idx = [self.get_channel_ids().index(chan) for chan in channel_ids]
-                filtered_chunk[:, pos:pos+end0-start0] = filtered_chunk0[chan_idx, start0:end0]
+                chunk_slices.append((ich, start0, end0, pos))
                 pos += (end0-start0)
+            if self._n_jobs == 1 or len(chunk_slices) == 1:
+                for ich, start0, end0, pos in chunk_slices:
+                    if self._read_ahead:
+                        filtered_chunk0 = self._get_filtered_chunk_read_ahead(ich, chunk_channel_ids)
+                    else:
+                        filtered_chunk0 = self._get_filtered_chunk(ich, chunk_channel_ids)
+                    filtered_chunk[:, pos:pos+end0-start0] = filtered_chunk0[chan_idx, start0:end0]
+            elif self._backend == 'thread':
+                # threads share memory: each job writes its chunk straight into the output
+                Parallel(n_jobs=self._n_jobs, prefer='threads')(
+                    delayed(self._fill_filtered_chunk)(filtered_chunk, chunk_channel_ids, chan_idx,
+                                                       ich, start0, end0, pos)
+                    for ich, start0, end0, pos in chunk_slices)
+            else:
+                # only chunks missing from the cache are sent to the worker processes
+                chunks = {}
+                if chunk_channel_ids is None:
+                    for ich, _, _, _ in chunk_slices:
+                        chunks[ich] = self._get_cached_chunk(ich)
+                missing = [ich for ich, _, _, _ in chunk_slices if chunks.get(ich) is None]
+                output = Parallel(n_jobs=self._n_jobs, prefer='processes')(
+                    delayed(_filter_chunk_by_index)(self, ich, chunk_channel_ids) for ich in missing)
+                for ich, filtered_chunk0 in zip(missing, output):
+                    chunks[ich] = filtered_chunk0
+                    if chunk_channel_ids is None:
+                        self._add_cached_chunk(ich, filtered_chunk0)
+                for ich, start0, end0, pos in chunk_slices:
+                    filtered_chunk[:, pos:pos+end0-start0] = chunks[ich][chan_idx, start0:end0]
         else:
-            filtered_chunk = self.filter_chunk(start_frame=start_frame, end_frame=end_frame)[channel_ids, :]
+            filtered_chunk = self.filter_chunk(start_frame=start_frame, end_frame=end_frame,
+                                               channel_ids=chunk_channel_ids)[chan_idx, :]
         return filtered_chunk
 
+    def _get_filtered_dtype(self):
+        return self._get_metadata('filtered_dtype',
+                                  lambda: self._recording.get_traces(start_frame=0, end_frame=1).dtype)
+
     @abstractmethod
-    def filter_chunk(self, *, start_frame, end_frame):
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
         raise NotImplementedError('filter_chunk not implemented')
 
-    def _get_filtered_chunk(self, ind):
-        if self._cache_chunks:
-            code = str(ind)
-            chunk0 = self._filtered_cache_chunks.get(code)
-        else:
-            chunk0 = None
+    def _get_filtered_chunk(self, ind, channel_ids=None):
+        start0 = ind * self._chunk_size
+        end0 = (ind + 1) * self._chunk_size
+        if channel_ids is not None:
+            return self.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=channel_ids)
+
+        chunk0 = self._get_cached_chunk(ind)
         if chunk0 is not None:
             return chunk0
 
-        start0 = ind * self._chunk_size
-        end0 = (ind + 1) * self._chunk_size
         chunk1 = self.filter_chunk(start_frame=start0, end_frame=end0)
-        if self._cache_chunks:
-            self._filtered_cache_chunks.add(code, chunk1)
-        
+        self._add_cached_chunk(ind, chunk1)
+
         return chunk1
-            
+
+    def _get_filtered_chunk_read_ahead(self, ind, channel_ids=None):
+        # chunk ind + 1 is filtered in the background while chunk ind is consumed
+        future = self._pop_read_ahead_job(ind, channel_ids)
+        self._submit_read_ahead(ind + 1, channel_ids)
+        if future is not None and not future.cancelled():
+            chunk0 = future.result()
+            if channel_ids is None:
+                self._add_cached_chunk(ind, chunk0)
+            return chunk0
+        return self._get_filtered_chunk(ind, channel_ids)
+
+    def _submit_read_ahead(self, ind, channel_ids=None):
+        # starts filtering chunk ind in the background thread, unless it is out of the recording, already
+        # pending, or cached
+        if ind * self._chunk_size >= self.get_num_frames():
+            return
+        key = (ind, None if channel_ids is None else tuple(channel_ids))
+        with self._read_ahead_lock:
+            if self._read_ahead_job is not None:
+                if self._read_ahead_job[0] == key:
+                    return
+                # a single chunk is read ahead: a stale job is dropped if it has not started yet
+                self._read_ahead_job[1].cancel()
+                self._read_ahead_job = None
+            if channel_ids is None and self._get_cached_chunk(ind) is not None:
+                return
+            if self._read_ahead_executor is None:
+                self._read_ahead_executor = ThreadPoolExecutor(max_workers=1)
+                weakref.finalize(self, self._read_ahead_executor.shutdown, wait=False)
+            future = self._read_ahead_executor.submit(self.filter_chunk, start_frame=ind * self._chunk_size,
+                                                      end_frame=(ind + 1) * self._chunk_size,
+                                                      channel_ids=channel_ids)
+            self._read_ahead_job = (key, future)
+
+    def _pop_read_ahead_job(self, ind, channel_ids=None):
+        # future of the chunk filtered in the background, if it is the one requested
+        key = (ind, None if channel_ids is None else tuple(channel_ids))
+        with self._read_ahead_lock:
+            if self._read_ahead_job is None or self._read_ahead_job[0] != key:
+                return None
+            future = self._read_ahead_job[1]
+            self._read_ahead_job = None
+        return future
+
+    def _fill_filtered_chunk(self, filtered_chunk, channel_ids, chan_idx, ind, start0, end0, pos):
+        filtered_chunk0 = self._get_filtered_chunk(ind, channel_ids)
+        filtered_chunk[:, pos:pos + end0 - start0] = filtered_chunk0[chan_idx, start0:end0]
+
+    def _read_chunk(self, i1, i2, channel_ids=None, dtype='float64'):
+        # reads frames [i1, i2) of the parent recording, zero-padded outside of the recording
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        M = len(channel_ids)
+        N = self._get_input_num_frames()
+        if i1 < 0:
+            i1b = 0
+        else:
+            i1b = i1
+        if i2 > N:
+            i2b = N
+        else:
+            i2b = i2
+        ret = np.zeros((M, i2 - i1), dtype=dtype)
+        ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(channel_ids=channel_ids, start_frame=i1b,
+                                                                end_frame=i2b)
+        return ret
+
+    def _get_cached_chunk(self, ind):
+        if self._filtered_cache_chunks is not None:
+            return self._filtered_cache_chunks.get((self.id, ind))
+        else:
+            return None
+
+    def _add_cached_chunk(self, ind, chunk):
+        if self._filtered_cache_chunks is not None:
+            self._filtered_cache_chunks.add((self.id, ind), chunk)
+
+    def stream(self, block_size=None, start_frame=0, channel_ids=None, poll_interval=None, timeout=None):
+        '''
+        Iterates over filtered blocks of traces, following the underlying recording while it grows.
+
+        In causal mode, blocks are yielded as soon as the underlying frames are available and each frame is
+        filtered exactly once. Otherwise, a block is yielded only when the padding after it is available.
+
+        Parameters
+        ----------
+        block_size: int or None
+            Maximum number of frames of each block. If None, the chunk size is used.
+        start_frame: int
+            First frame of the stream (default 0).
+        channel_ids: list or None
+            Channels to be returned. If None all channels are returned.
+        poll_interval: float or None
+            If None, the iteration stops at the current end of the recording. Otherwise, the number of frames
+            of the recording is checked every poll_interval seconds for new data.
+        timeout: float or None
+            When polling, the iteration stops if no new frames arrive for timeout seconds. If None, it never stops.
+
+        Yields
+        ------
+        start_frame: int
+            First frame of the block
+        traces: np.array
+            The filtered traces of the block (channels x frames)
+        '''
+        if block_size is None:
+            block_size = self._chunk_size if self._chunk_size is not None else 30000
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
+        pos = start_frame
+        last_data_time = time.time()
+        while True:
+            if poll_interval is not None:
+                # the recording may have grown since the last poll
+                self.refresh_metadata()
+            num_frames = self._recording.get_num_frames()
+            if poll_interval is None:
+                available = num_frames
+            else:
+                available = num_frames - self._get_stream_lookahead()
+            if available > pos:
+                end = min(pos + block_size, available)
+                traces = self.filter_chunk(start_frame=pos, end_frame=end, channel_ids=channel_ids)
+                yield pos, traces
+                pos = end
+                last_data_time = time.time()
+            else:
+                if poll_interval is None:
+                    break
+                if timeout is not None and time.time() - last_data_time > timeout:
+                    break
+                time.sleep(poll_interval)
+
+    def _get_stream_lookahead(self):
+        if self._causal:
+            return 0
+        else:
+            return getattr(self, '_padding', 0)
+
+    def _filter_causal_chunk(self, start_frame, end_frame, channel_ids=None):
+        # single-pass sosfilt of the filters defined by second-order sections (self._sos): the filter state is
+        # carried from one call to the next, so sequential reads filter each frame once and need no padding
+        import scipy.signal as ss
+        N = self._get_input_num_frames()
+        stop = min(end_frame, N)
+        checkpoint_frames = _causal_checkpoint_chunks * (self._chunk_size if self._chunk_size is not None else 30000)
+        filtered = np.zeros((self.get_num_channels(), end_frame - start_frame), dtype=self._compute_dtype)
+        with self._causal_lock:
+            frame, zi = self._get_causal_state(start_frame)
+            while frame < stop:
+                # blocks are aligned to the checkpoints
+                block_end = min((frame // checkpoint_frames + 1) * checkpoint_frames, stop)
+                traces = self._recording.get_traces(start_frame=frame, end_frame=block_end)
+                traces = traces.astype(self._compute_dtype)
+                if zi is None:
+                    zi = ss.sosfilt_zi(self._sos)[:, np.newaxis, :] * traces[np.newaxis, :, :1]
+                    zi = zi.astype(self._compute_dtype)
+                traces, zi = ss.sosfilt(self._sos, traces, axis=1, zi=zi)
+                i1 = max(frame, start_frame)
+                i2 = min(block_end, end_frame)
+                if i2 > i1:
+                    filtered[:, i1 - start_frame:i2 - start_frame] = traces[:, i1 - frame:i2 - frame]
+                frame = block_end
+                self._causal_last_state = (frame, zi)
+                if frame % checkpoint_frames == 0:
+                    self._causal_states[frame] = zi
+        if channel_ids is not None:
+            channel_index = self.get_channel_index()
+            filtered = filtered[[channel_index[chan] for chan in channel_ids]]
+        return filtered
+
+    def _get_causal_state(self, frame):
+        # latest known filter state at or before frame. (0, None) means starting from the beginning
+        best_frame, best_zi = 0, None
+        if self._causal_last_state is not None and self._causal_last_state[0] <= frame:
+            best_frame, best_zi = self._causal_last_state
+        checkpoints = [f for f in self._causal_states.keys() if best_frame < f <= frame]
+        if len(checkpoints) > 0:
+            best_frame = max(checkpoints)
+            best_zi = self._causal_states[best_frame]
+        return best_frame, best_zi
+
+    def __getstate__(self):
+        # the chunk cache stays in the parent process
+        state = self.__dict__.copy()
+        state['_cache_chunks'] = False
+        state['_filtered_cache_chunks'] = None
+        del state['_causal_lock']
+        # the read-ahead thread stays in the parent process
+        state['_read_ahead_executor'] = None
+        state['_read_ahead_job'] = None
+        del state['_read_ahead_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._causal_lock = threading.Lock()
+        self._read_ahead_lock = threading.Lock()
+
+
+def _get_sos_padding(sos, tol=1e-5):
+    '''
+    Number of samples after which the impulse response of the sos filter has decayed below
+    tol times its peak amplitude. This is the padding needed on each side of a chunk.
+    '''
+    import scipy.signal as ss
+    _, poles, _ = ss.sos2zpk(sos)
+    radius = np.max(np.abs(poles)) if len(poles) > 0 else 0
+    if radius == 0:
+        return 3 * len(sos)
+    # upper bound from the slowest pole, then refined on the actual impulse response
+    max_len = int(np.ceil(np.log(tol) / np.log(radius))) + 3 * len(sos)
+    impulse = np.zeros(max_len)
+    impulse[0] = 1
+    response = np.abs(ss.sosfilt(sos, impulse))
+    above = np.nonzero(response > tol * np.max(response))[0]
+    return int(above[-1]) + 1
+
+
+def _filter_chunk_by_index(recording, ind, channel_ids=None):
+    start0 = ind * recording._chunk_size
+    end0 = (ind + 1) * recording._chunk_size
+    return recording.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=channel_ids)
+
+
+_chunk_cache_settings = {'max_memory': 500 * 1024 ** 2}
+_global_chunk_cache = None
 
 
 class FilteredChunkCache():
-    def __init__(self):
-        self._chunks_by_code = dict()
-        self._codes = []
-        self._total_size = 0
-        self._max_size = 1024 * 1024 * 100
+    '''
+    Least-recently-used cache of filtered chunks with a memory budget in bytes.
+
+    The same cache can be passed as 'cache_chunks' to several filter extractors (e.g. all the filters of a
+    preprocessing chain), so that a single budget bounds the memory used by all of them. Chunks are keyed by
+    (extractor id, chunk index).
+
+    If 'max_disk' is given, chunks evicted from memory are spilled to a memory-mapped scratch file and later
+    hits are copied from the file (while the cache is locked, so that a concurrent spill cannot recycle the slot
+    being read). The scratch file is split in equal slots: chunks larger than a slot are not spilled. The slot size
+    is 'disk_slot_nbytes', or the size of the first spilled chunk if None, so a cache shared by extractors with
+    different numbers of channels should set it to the size of the largest chunk. The scratch file is removed when
+    the cache (i.e. the extractors using it) is garbage-collected.
+
+    Parameters
+    ----------
+    max_memory: int or None
+        Memory budget in bytes. If None, the default budget set with set_chunk_cache_memory() is used.
+    max_disk: int or None
+        Size in bytes of the on-disk tier. If None or 0, evicted chunks are discarded.
+    tmp_folder: str or None
+        Folder for the scratch file. If None, the system temporary folder is used.
+    disk_slot_nbytes: int or None
+        Size in bytes of the slots of the scratch file. If None, the size of the first spilled chunk is used.
+    '''
+    def __init__(self, max_memory=None, max_disk=None, tmp_folder=None, disk_slot_nbytes=None):
+        if max_memory is None:
+            max_memory = _chunk_cache_settings['max_memory']
+        self._chunks_by_code = OrderedDict()
+        self._memory = 0
+        self._max_memory = int(max_memory)
+        if max_disk:
+            self._disk_chunks = MemmapChunkStore(max_disk=max_disk, tmp_folder=tmp_folder,
+                                                 slot_nbytes=disk_slot_nbytes)
+        else:
+            self._disk_chunks = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def add(self, code, chunk):
-        self._chunks_by_code[code] = chunk
-        self._codes.append(code)
-        self._total_size = self._total_size + chunk.size
-        if self._total_size > self._max_size:
-            ii = 0
-            while (ii < len(self._codes)) and (self._total_size > self._max_size / 2):
-                self._total_size = self._total_size - self._chunks_by_code[self._codes[ii]].size
-                del self._chunks_by_code[self._codes[ii]]
-                ii = ii + 1
-            self._codes = self._codes[ii:]
+        with self._lock:
+            if code in self._chunks_by_code:
+                self._memory -= self._chunks_by_code.pop(code).nbytes
+            if self._disk_chunks is not None:
+                self._disk_chunks.remove(code)
+            if chunk.nbytes > self._max_memory:
+                self._spill(code, chunk)
+                return
+            self._chunks_by_code[code] = chunk
+            self._memory += chunk.nbytes
+            self._evict()
 
     def get(self, code):
-        if code in self._chunks_by_code:
-            return self._chunks_by_code[code]
+        with self._lock:
+            chunk = self._chunks_by_code.get(code)
+            if chunk is not None:
+                self.hits += 1
+                self._chunks_by_code.move_to_end(code)
+                return chunk
+            if self._disk_chunks is not None:
+                chunk = self._disk_chunks.get(code)
+                if chunk is not None:
+                    self.disk_hits += 1
+                    # the slot can be recycled as soon as the lock is released
+                    return np.array(chunk)
+            self.misses += 1
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._chunks_by_code.clear()
+            self._memory = 0
+            if self._disk_chunks is not None:
+                self._disk_chunks.clear()
+
+    def set_max_memory(self, max_memory):
+        with self._lock:
+            self._max_memory = int(max_memory)
+            self._evict()
+
+    def get_memory(self):
+        return self._memory
+
+    def get_max_memory(self):
+        return self._max_memory
+
+    def get_stats(self):
+        stats = {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions,
+                 'num_chunks': len(self._chunks_by_code), 'memory': self._memory, 'max_memory': self._max_memory}
+        if self._disk_chunks is not None:
+            stats['num_disk_chunks'] = self._disk_chunks.get_num_chunks()
+            stats['max_disk'] = self._disk_chunks.get_max_disk()
+        return stats
+
+    def _evict(self):
+        # drop least recently used chunks until the budget is met
+        while self._memory > self._max_memory:
+            code, chunk = self._chunks_by_code.popitem(last=False)
+            self._memory -= chunk.nbytes
+            self.evictions += 1
+            self._spill(code, chunk)
+
+    def _spill(self, code, chunk):
+        if self._disk_chunks is not None:
+            self._disk_chunks.add(code, chunk)
+
+
+class MemmapChunkStore():
+    '''
+    Bounded store of chunks in a memory-mapped scratch file, used as the on-disk tier of FilteredChunkCache.
+
+    The file is split in equal slots that are recycled in least-recently-used order: chunks larger than a slot are
+    not stored. Returned chunks are read-only views of the file, valid until their slot is recycled.
+
+    Parameters
+    ----------
+    max_disk: int
+        Maximum size of the scratch file in bytes
+    tmp_folder: str or None
+        Folder for the scratch file. If None, the system temporary folder is used.
+    slot_nbytes: int or None
+        Size in bytes of the slots. If None, the size of the first stored chunk is used.
+    '''
+    def __init__(self, max_disk, tmp_folder=None, slot_nbytes=None):
+        self._max_disk = int(max_disk)
+        self._tmp_folder = tmp_folder
+        self._tmp_file = None
+        self._memmap = None
+        self._slot_nbytes = slot_nbytes
+        self._free_slots = []
+        self._slots_by_code = OrderedDict()
+        self._finalizer = None
+
+    def add(self, code, chunk):
+        if self._memmap is None:
+            self._create_file(self._slot_nbytes if self._slot_nbytes is not None else chunk.nbytes)
+            if self._memmap is None:
+                return
+        if chunk.nbytes > self._slot_nbytes:
+            return
+        if code in self._slots_by_code:
+            self.remove(code)
+        if len(self._free_slots) > 0:
+            slot = self._free_slots.pop()
         else:
+            _, (slot, _, _) = self._slots_by_code.popitem(last=False)
+        data = np.ascontiguousarray(chunk)
+        self._memmap[slot, :data.nbytes] = data.reshape(-1).view(np.uint8)
+        self._slots_by_code[code] = (slot, data.dtype, data.shape)
+
+    def get(self, code):
+        if code not in self._slots_by_code:
             return None
+        self._slots_by_code.move_to_end(code)
+        slot, dtype, shape = self._slots_by_code[code]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        chunk = self._memmap[slot, :nbytes].view(dtype).reshape(shape)
+        chunk.flags.writeable = False
+        return chunk
+
+    def remove(self, code):
+        if code in self._slots_by_code:
+            slot, _, _ = self._slots_by_code.pop(code)
+            self._free_slots.append(slot)
+
+    def clear(self):
+        for code in list(self._slots_by_code.keys()):
+            self.remove(code)
+
+    def get_num_chunks(self):
+        return len(self._slots_by_code)
+
+    def get_max_disk(self):
+        return self._max_disk
+
+    def get_filename(self):
+        return self._tmp_file
+
+    def _create_file(self, slot_nbytes):
+        num_slots = self._max_disk // slot_nbytes
+        if num_slots == 0:
+            return
+        fd, self._tmp_file = tempfile.mkstemp(suffix='.dat', dir=self._tmp_folder)
+        os.close(fd)
+        self._slot_nbytes = slot_nbytes
+        self._free_slots = list(range(num_slots))[::-1]
+        self._memmap = np.memmap(self._tmp_file, dtype='uint8', mode='w+', shape=(num_slots, slot_nbytes))
+        self._finalizer = weakref.finalize(self, _remove_file, self._tmp_file)
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except Exception:
+        print("Unable to remove temporary file")
+
+
+def get_global_chunk_cache():
+    '''
+    Returns the process-wide chunk cache used by filter extractors created with cache_chunks='global'.
+
+    Returns
+    -------
+    cache: FilteredChunkCache
+        The shared chunk cache
+    '''
+    global _global_chunk_cache
+    if _global_chunk_cache is None:
+        _global_chunk_cache = FilteredChunkCache()
+    return _global_chunk_cache
+
+
+def set_chunk_cache_memory(max_memory):
+    '''
+    Sets the default memory budget of new chunk caches and of the process-wide chunk cache.
+
+    Parameters
+    ----------
+    max_memory: int
+        Memory budget in bytes
+    '''
+    _chunk_cache_settings['max_memory'] = int(max_memory)
+    if _global_chunk_cache is not None:
+        _global_chunk_cache.set_max_memory(max_memory)
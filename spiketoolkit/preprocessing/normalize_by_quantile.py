@@ -1,8 +1,10 @@
 from spikeextractors import RecordingExtractor
+from .elementwise import ElementwiseRecording
+from .preprocessing_tools import get_recording_statistics
 import numpy as np
 
 
-class NormalizeByQuantileRecording(RecordingExtractor):
+class NormalizeByQuantileRecording(ElementwiseRecording):
 
     preprocessor_name = 'NormalizeByQuantile'
     installed = True  # check at class level if installed or not
@@ -25,45 +27,20 @@ class NormalizeByQuantileRecording(RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
         self._recording = recording
 
-        random_data = self._get_random_data_for_scaling(seed=seed).ravel()
-        loc_q1, pre_median, loc_q2 = np.quantile(random_data, q=[q1, 0.5, q2])
+        loc_q1, pre_median, loc_q2 = get_recording_statistics(recording, seed=seed).get_quantiles([q1, 0.5, q2])
         pre_scale = abs(loc_q2 - loc_q1)
 
         self._scalar = scale / pre_scale
         self._offset = median - pre_median * self._scalar
-        RecordingExtractor.__init__(self)
-        self.copy_channel_properties(recording=self._recording)
+        ElementwiseRecording.__init__(self, recording)
 
-    def _get_random_data_for_scaling(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in random_ints:
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
+    def _get_output_dtype(self, dtype):
+        return (np.zeros(1, dtype=dtype) * self._scalar + self._offset).dtype
 
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
-
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = self.get_num_frames()
-        if channel_ids is None:
-            channel_ids = self.get_channel_ids()
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame)
-        return traces * self._scalar + self._offset
+    def _apply(self, traces):
+        traces *= self._scalar
+        traces += self._offset
+        return traces
 
 
 def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0):
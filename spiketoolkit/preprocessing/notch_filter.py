@@ -1,4 +1,4 @@
-from .filterrecording import FilterRecording
+from .filterrecording import FilterRecording, _get_sos_padding
 import spikeextractors as se
 import numpy as np
 
@@ -8,6 +8,9 @@ try:
 except ImportError:
     HAVE_NFR = False
 
+# largest padding derived from padding_tol: the fixed padding of the notch filter in previous versions
+_max_derived_padding = 3000
+
 
 class NotchFilterRecording(FilterRecording):
 
@@ -16,72 +19,139 @@ class NotchFilterRecording(FilterRecording):
     preprocessor_gui_params = [
         {'name': 'freq', 'type': 'float', 'value':3000.0, 'default':3000.0, 'title': "Frequency"},
         {'name': 'q', 'type': 'int', 'value':30, 'default':30, 'title': "Quality factor"},
+        {'name': 'harmonics', 'type': 'int', 'value': None, 'default': None, 'title':
+            "Number of harmonics of freq to be removed (freq, 2*freq, ...)"},
         {'name': 'chunk_size', 'type': 'int', 'value': 30000, 'default': 30000, 'title':
             "Chunk size for the filter."},
         {'name': 'cache_chunks', 'type': 'bool', 'value': False, 'default': False, 'title':
             "If True filtered traces are computed and cached"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of parallel jobs used to filter the chunks of a get_traces call"},
+        {'name': 'backend', 'type': 'str', 'value': 'thread', 'default': 'thread', 'title':
+            "Parallel backend for the chunks ('thread' or 'process')"},
+        {'name': 'read_ahead', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True the next chunk is filtered in a background thread during sequential reads"},
+        {'name': 'compute_dtype', 'type': 'dtype', 'value': 'float64', 'default': 'float64', 'title':
+            "Dtype used for the filter computation ('float32' or 'float64')"},
+        {'name': 'causal', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True the filter is applied causally with a carried state"},
+        {'name': 'padding', 'type': 'int', 'value': None, 'default': None, 'title':
+            "Padding (in frames) on each side of the chunks. If None it is derived from padding_tol, up to 3000"},
+        {'name': 'padding_tol', 'type': 'float', 'value': 1e-5, 'default': 1e-5, 'title':
+            "Relative amplitude of the impulse response below which it is truncated to derive the padding"},
     ]
     installation_mesg = "To use the NotchFilterRecording, install scipy: \n\n pip install scipy\n\n"  # error message when not installed
 
-    def __init__(self, recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False):
+    def __init__(self, recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False, n_jobs=1, backend='thread',
+                 compute_dtype='float64', causal=False, read_ahead=False, harmonics=None, padding=None,
+                 padding_tol=1e-5):
         assert HAVE_NFR, "To use the NotchFilterRecording, install scipy: \n\n pip install scipy\n\n"
+        if np.dtype(compute_dtype) not in [np.dtype('float32'), np.dtype('float64')]:
+            raise ValueError("'compute_dtype' must be 'float32' or 'float64'")
         self._freq = freq
         self._q = q
+        self._harmonics = harmonics
+        self._compute_dtype = np.dtype(compute_dtype)
+        self._causal = causal
         fn = 0.5 * float(recording.get_sampling_frequency())
-        self._b, self._a = ss.iirnotch(self._freq / fn, self._q)
+        if np.isscalar(freq):
+            if harmonics is None:
+                self._freqs = np.array([freq], dtype='float64')
+            else:
+                self._freqs = freq * np.arange(1, int(harmonics) + 1, dtype='float64')
+        else:
+            if harmonics is not None:
+                raise ValueError("'harmonics' can only be used with a single 'freq'")
+            self._freqs = np.array(freq, dtype='float64')
+        if len(self._freqs) == 0:
+            raise ValueError("'freq' must contain at least one frequency")
+        if np.any(self._freqs <= 0) or np.any(self._freqs >= fn):
+            raise ValueError("The notch frequencies must be between 0 and the Nyquist frequency")
+        qs = np.broadcast_to(q, self._freqs.shape)
+        # all the notches are applied as a single cascade of second-order sections
+        self._sos = np.concatenate([ss.tf2sos(*ss.iirnotch(f / fn, q_f)) for f, q_f in zip(self._freqs, qs)])
 
-        if not np.all(np.abs(np.roots(self._a)) < 1):
+        if not np.all(np.abs(ss.sos2zpk(self._sos)[1]) < 1):
             raise ValueError('Filter is not stable')
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
+        if padding is None:
+            self._padding = min(_get_sos_padding(self._sos, tol=padding_tol), _max_derived_padding)
+        else:
+            self._padding = padding
+        self._sos = self._sos.astype(self._compute_dtype)
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 n_jobs=n_jobs, backend=backend,
+                                 read_ahead=read_ahead)
         self.copy_channel_properties(recording)
 
-    def filter_chunk(self, *, start_frame, end_frame):
-        padding = 3000
-        i1 = start_frame - padding
-        i2 = end_frame + padding
-        padded_chunk = self._read_chunk(i1, i2)
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        if self._causal:
+            return self._filter_causal_chunk(start_frame, end_frame, channel_ids)
+        i1 = start_frame - self._padding
+        i2 = end_frame + self._padding
+        padded_chunk = self._read_chunk(i1, i2, channel_ids=channel_ids, dtype=self._compute_dtype)
         filtered_padded_chunk = self._do_filter(padded_chunk)
         return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
 
+    def _get_pipeline_margin(self):
+        return self._padding
+
+    def _process_pipeline_chunk(self, traces, start_frame, margin):
+        return self._do_filter(traces)
+
     def _do_filter(self, chunk):
-        chunk_filtered = ss.filtfilt(self._b, self._a, chunk, axis=1)
+        chunk_filtered = ss.sosfiltfilt(self._sos, chunk, axis=1)
 
         return chunk_filtered
 
-    def _read_chunk(self, i1, i2):
-        M = len(self._recording.get_channel_ids())
-        N = self._recording.get_num_frames()
-        if i1 < 0:
-            i1b = 0
-        else:
-            i1b = i1
-        if i2 > N:
-            i2b = N
-        else:
-            i2b = i2
-        ret = np.zeros((M, i2 - i1))
-        ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b)
-        return ret
-
 
-def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_to_file=False, cache_chunks=False):
+def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_to_file=False, cache_chunks=False, n_jobs=1,
+                 backend='thread', compute_dtype='float64', causal=False, read_ahead=False, harmonics=None,
+                 padding=None, padding_tol=1e-5):
     '''
-    Performs a notch filter on the recording extractor traces using scipy iirnotch function.
+    Performs a notch filter on the recording extractor traces using scipy iirnotch function. The filter is
+    applied as second-order sections with sosfiltfilt, with a padding derived from the decay of its impulse response.
 
     Parameters
     ----------
     recording: RecordingExtractor
         The recording extractor to be notch-filtered.
-    freq: int or float
-        The target frequency of the notch filter.
-    q: int
-        The quality factor of the notch filter.
+    freq: int, float, or list
+        The target frequency of the notch filter. If a list, all the frequencies are removed in a single pass,
+        with a cascade of notch filters.
+    q: int or list
+        The quality factor of the notch filter. If a list, one quality factor for each frequency.
+    harmonics: int or None
+        If given (with a single freq), the harmonics freq, 2*freq, ..., harmonics*freq are removed, e.g.
+        freq=50 and harmonics=4 removes the line noise at 50, 100, 150, and 200 Hz (default None).
     chunk_size: int
         The chunk size to be used for the filtering.
     cache_to_file: bool (default False).
         If True, filtered traces are computed and cached all at once on disk in temp file 
-    cache_chunks: bool (default False).
-        If True then each chunk is cached in memory (in a dict)
+    cache_chunks: bool, 'global', or FilteredChunkCache (default False).
+        If True then each chunk is cached in memory (in a LRU cache with the default memory budget).
+        If 'global' the process-wide chunk cache is used. A FilteredChunkCache can be passed to share
+        the same cache (and memory budget) among several extractors, or to set its budget and on-disk tier.
+    n_jobs: int
+        Number of jobs used to filter in parallel the chunks spanned by a get_traces call (default 1).
+    backend: str
+        'thread' or 'process'. Pool used when n_jobs is not 1 (default 'thread').
+    read_ahead: bool
+        If True, while a chunk is consumed the next one is filtered in a background thread, so that sequential
+        reads (e.g. writing to a binary file) overlap reading and filtering (default False).
+    compute_dtype: str
+        'float64' or 'float32'. Dtype of the padded chunks during filtering (default 'float64').
+    causal: bool
+        If True, the filter is applied forward only with sosfilt, carrying the filter state from one chunk to
+        the next, instead of sosfiltfilt. Sequential reads need no padding and filter_recording.stream() yields
+        filtered blocks while the recording grows (default False).
+    padding: int or None
+        Number of frames read on each side of a chunk. If None, it is the length after which the impulse response
+        decays below padding_tol times its peak, up to 3000 frames (default None).
+    padding_tol: float
+        Relative amplitude below which the impulse response is truncated to derive the padding (default 1e-5).
+        Narrow notches ring for a long time: at 30 kHz, a 50 Hz notch with q=30 would need about 20000 frames of
+        padding on each side, and is padded with 3000 frames unless a larger padding is given, at the cost of a
+        filtering error near the chunk edges of the order of the truncated ringing.
     Returns
     -------
     filter_recording: NotchFilterRecording
@@ -97,6 +167,14 @@ def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_to_file=Fal
         q=q,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
+        n_jobs=n_jobs,
+        backend=backend,
+        compute_dtype=compute_dtype,
+        causal=causal,
+        read_ahead=read_ahead,
+        harmonics=harmonics,
+        padding=padding,
+        padding_tol=padding_tol,
     )
     if cache_to_file:
         return se.CacheRecordingExtractor(notch_recording, chunk_size=chunk_size)
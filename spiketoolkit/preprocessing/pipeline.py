@@ -0,0 +1,154 @@
+from .filterrecording import FilterRecording
+from .preprocessinglist import preprocessers_full_list, preprocesser_dict
+import numpy as np
+
+
+class Pipeline(FilterRecording):
+
+    def __init__(self, recording, steps, chunk_size=30000, cache_chunks=False, n_jobs=1, backend='thread',
+                 compute_dtype='float64', read_ahead=False):
+        if np.dtype(compute_dtype) not in [np.dtype('float32'), np.dtype('float64')]:
+            raise ValueError("'compute_dtype' must be 'float32' or 'float64'")
+        self._compute_dtype = np.dtype(compute_dtype)
+
+        # the preprocessors are instantiated as a nested chain, so that parameters estimated at construction
+        # (e.g. the whitening matrix) see the same data as without the pipeline
+        self._stages = []
+        stage = recording
+        for step in steps:
+            pp_class, pp_kwargs = _parse_step(step)
+            stage = pp_class(stage, **pp_kwargs)
+            self._stages.append(stage)
+        if len(self._stages) == 0:
+            raise ValueError("'steps' must contain at least one preprocessing step")
+
+        # the trailing run of stages that work chunk-wise is fused, the others are read through as a source
+        first_fused = len(self._stages)
+        while first_fused > 0 and _is_fusable(self._stages[first_fused - 1]):
+            first_fused -= 1
+        if first_fused == 0:
+            source = recording
+        else:
+            source = self._stages[first_fused - 1]
+        self._fused_stages = self._stages[first_fused:]
+        self._margin = int(np.sum([stage._get_pipeline_margin() for stage in self._fused_stages]))
+        self._dtype = self._stages[-1].get_dtype()
+
+        FilterRecording.__init__(self, recording=source, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 n_jobs=n_jobs, backend=backend,
+                                 read_ahead=read_ahead)
+        self.copy_channel_properties(self._stages[-1])
+
+    def get_stages(self):
+        return self._stages
+
+    def get_fused_stages(self):
+        return self._fused_stages
+
+    def get_margin(self):
+        return self._margin
+
+    def _get_stream_lookahead(self):
+        return self._margin
+
+    def refresh_metadata(self):
+        FilterRecording.refresh_metadata(self)
+        # the fused stages are not read through, but they are part of the chain
+        if self._fused_stages:
+            self._stages[-1].refresh_metadata()
+
+    def _get_filtered_dtype(self):
+        return self._dtype
+
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        i1 = start_frame - self._margin
+        i2 = end_frame + self._margin
+        # stages like common reference and whitening need all channels
+        traces = self._read_chunk(i1, i2, dtype=self._compute_dtype)
+        # frames outside of the recording, which the nested chain reads as zeros at each stage
+        N = self._get_input_num_frames()
+        outside_start = max(min(-i1, i2 - i1), 0)
+        outside_end = min(max(N - i1, 0), i2 - i1)
+        for stage in self._fused_stages:
+            traces = stage._process_pipeline_chunk(traces, i1, self._margin)
+            traces[:, :outside_start] = 0
+            traces[:, outside_end:] = 0
+        traces = traces[:, start_frame - i1:end_frame - i1]
+        if channel_ids is not None:
+            channel_index = self.get_channel_index()
+            traces = traces[[channel_index[chan] for chan in channel_ids]]
+        return traces.astype(self._dtype, copy=False)
+
+
+def _parse_step(step):
+    if isinstance(step, (tuple, list)):
+        pp_class, pp_kwargs = step
+    else:
+        pp_class, pp_kwargs = step, {}
+    if isinstance(pp_class, str):
+        if pp_class not in preprocesser_dict:
+            raise ValueError(f"'{pp_class}' is not a preprocessor name. Available preprocessors are: "
+                             f"{list(preprocesser_dict.keys())}")
+        pp_class = preprocesser_dict[pp_class]
+    if pp_class not in preprocessers_full_list:
+        raise ValueError(f"{pp_class} is not a preprocessor class")
+    if pp_kwargs is None:
+        pp_kwargs = {}
+    return pp_class, pp_kwargs
+
+
+def _is_fusable(stage):
+    # causal filters carry their state from chunk to chunk and are read through
+    return hasattr(stage, '_process_pipeline_chunk') and not getattr(stage, '_causal', False)
+
+
+def pipeline(recording, steps, chunk_size=30000, cache_chunks=False, n_jobs=1, backend='thread',
+             compute_dtype='float64', read_ahead=False):
+    '''
+    Builds a preprocessing pipeline that runs a chain of preprocessors as a single chunk-wise pass.
+
+    The preprocessors are chained as usual, but when traces are requested the raw data are read once per chunk,
+    with a margin that covers the padding of all the stages, and every stage is applied in turn to the same
+    buffer. Stages that cannot be fused (e.g. 'Resample' and 'RemoveBadChannels') are read through: only the
+    preprocessors after the last of them are fused. Intermediate dtype casts are skipped and the output has the
+    dtype of the last preprocessor. Frames outside of the recording are reset to zero after each stage, and the
+    whitening subtracts the mean of each output chunk, so that the output matches the nested chain when its
+    preprocessors use the chunk size of the pipeline (up to the FFT filters, whose output depends slightly on the
+    length of the padded chunk).
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to be preprocessed
+    steps: list
+        List of (preprocessor, kwargs) tuples, where preprocessor is a class of preprocessers_full_list or its
+        preprocessor_name (e.g. 'BandpassFilter') and kwargs a dict with its parameters.
+    chunk_size: int
+        The chunk size used by the pipeline.
+    cache_chunks: bool, 'global', or FilteredChunkCache (default False).
+        If True, preprocessed chunks are cached in memory. If 'global' the process-wide chunk cache is used.
+    n_jobs: int
+        Number of jobs used to process in parallel the chunks spanned by a get_traces call (default 1).
+    backend: str
+        'thread' or 'process'. Pool used when n_jobs is not 1 (default 'thread').
+    read_ahead: bool
+        If True, while a chunk is consumed the next one is processed in a background thread, so that sequential
+        reads (e.g. writing to a binary file) overlap reading and processing (default False).
+    compute_dtype: str
+        'float64' or 'float32'. Dtype of the chunk buffer (default 'float64').
+
+    Returns
+    -------
+    pipeline_recording: Pipeline
+        The preprocessed recording extractor object
+    '''
+    return Pipeline(
+        recording=recording,
+        steps=steps,
+        chunk_size=chunk_size,
+        cache_chunks=cache_chunks,
+        n_jobs=n_jobs,
+        backend=backend,
+        compute_dtype=compute_dtype,
+        read_ahead=read_ahead
+    )
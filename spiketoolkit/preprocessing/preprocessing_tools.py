@@ -0,0 +1,245 @@
+from pathlib import Path
+import hashlib
+import tempfile
+import threading
+import weakref
+import numpy as np
+
+_fingerprint_num_slices = 5
+_fingerprint_slice_frames = 100
+_fingerprints = weakref.WeakKeyDictionary()
+_cache_settings = {'cache_folder': Path(tempfile.gettempdir()) / 'spiketoolkit_cache'}
+# RecordingStatistics of each recording extractor object, for each sampling
+_statistics = weakref.WeakKeyDictionary()
+_statistics_lock = threading.Lock()
+
+
+def get_recording_fingerprint(recording):
+    '''
+    Returns a fingerprint of the recording extractor, computed from its metadata (type, channel ids, locations,
+    number of frames, and sampling frequency) and from a few short slices of its traces, evenly spaced over the
+    recording. The fingerprint is computed once for each recording extractor object. It keys the caches on disk
+    (see set_cache_folder): since it only samples a few short slices of the traces and does not include the
+    parameters of the preprocessing, these caches are opt-in and should only be enabled for recordings that do not
+    change between sessions.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor
+
+    Returns
+    -------
+    fingerprint: str
+        The hexadecimal digest identifying the recording
+    '''
+    fingerprint = _fingerprints.get(recording)
+    if fingerprint is not None:
+        return fingerprint
+    h = hashlib.sha1()
+    N = recording.get_num_frames()
+    channel_ids = recording.get_channel_ids()
+    h.update(type(recording).__name__.encode())
+    h.update(str(list(channel_ids)).encode())
+    h.update(str((N, float(recording.get_sampling_frequency()))).encode())
+    try:
+        h.update(np.ascontiguousarray(recording.get_channel_locations(), dtype='float64').tobytes())
+    except Exception:
+        pass
+    starts = np.unique(np.linspace(0, max(N - _fingerprint_slice_frames, 0), _fingerprint_num_slices).astype(int))
+    for start in starts:
+        traces = recording.get_traces(start_frame=int(start), end_frame=int(min(start + _fingerprint_slice_frames, N)))
+        h.update(str(traces.dtype).encode())
+        h.update(np.ascontiguousarray(traces).tobytes())
+    fingerprint = h.hexdigest()
+    _fingerprints[recording] = fingerprint
+    return fingerprint
+
+
+class RecordingStatistics:
+    '''
+    Statistics of a recording extractor estimated from a sample of random chunks. Each statistic is computed once
+    and kept, while the chunks are read to compute it and released afterwards, so that the sample does not stay in
+    memory. The statistics only keep a weak reference to the recording extractor, which must be kept alive.
+    '''
+
+    def __init__(self, recording, num_chunks=50, chunk_length=500, seed=0):
+        self._recording = weakref.ref(recording)
+        self._num_chunks = num_chunks
+        self._chunk_length = chunk_length
+        self._seed = seed
+        self._start_frames = None
+        self._results = {}
+        self._lock = threading.RLock()
+
+    def get_chunks(self):
+        '''
+        Returns the sampled chunks (list of channels x frames arrays), read at each call
+        '''
+        recording = self._recording()
+        if recording is None:
+            raise ValueError("The recording extractor of the statistics has been deleted")
+        with self._lock:
+            N = recording.get_num_frames()
+            chunk_length = min(self._chunk_length, N)
+            if self._start_frames is None:
+                # drawn once, so that all the statistics are computed from the same chunks
+                if N > chunk_length:
+                    self._start_frames = np.random.RandomState(seed=self._seed).randint(0, N - chunk_length,
+                                                                                        size=self._num_chunks)
+                else:
+                    self._start_frames = [0]
+        return [recording.get_traces(start_frame=ff, end_frame=ff + chunk_length) for ff in self._start_frames]
+
+    def get_sample(self):
+        '''
+        Returns the sampled chunks concatenated (channels x frames), read at each call
+        '''
+        return np.concatenate(self.get_chunks(), axis=1)
+
+    def get_quantiles(self, q):
+        '''
+        Returns the quantiles q of the sampled values of all channels
+        '''
+        q = tuple(np.atleast_1d(q))
+        return self._get_result(('quantiles', q), lambda: np.quantile(self.get_sample().ravel(), q=q))
+
+    def get_std(self):
+        '''
+        Returns the standard deviation of each channel
+        '''
+        return self._get_result('std', lambda: np.std(self.get_sample(), axis=1))
+
+    def get_mad(self):
+        '''
+        Returns the median absolute deviation of each channel
+        '''
+        def _mad():
+            sample = self.get_sample()
+            return np.median(np.abs(sample - np.median(sample, axis=1, keepdims=True)), axis=1)
+        return self._get_result('mad', _mad)
+
+    def get_covariance(self):
+        '''
+        Returns the covariance between channels (channels x channels)
+        '''
+        return self._get_result('covariance', self._compute_covariance)
+
+    def get_saturation_threshold(self, q=0.001):
+        '''
+        Returns the saturation threshold, i.e. the lower (q) or upper (1 - q) quantile with the largest distance from
+        the median, and True if it is the lower one
+        '''
+        q_low, median, q_high = self.get_quantiles([q, 0.5, 1 - q])
+        if np.abs(median - q_low) > np.abs(median - q_high):
+            return q_low, True
+        else:
+            return q_high, False
+
+    def _get_result(self, key, compute):
+        with self._lock:
+            if key not in self._results:
+                self._results[key] = compute()
+            return self._results[key]
+
+    def _compute_covariance(self):
+        # accumulated chunk by chunk, on data shifted by the mean of the first chunk, which keeps the sums accurate
+        # for traces with large offsets
+        chunks = self.get_chunks()
+        M = chunks[0].shape[0]
+        sum_x = np.zeros(M)
+        sum_xxt = np.zeros((M, M))
+        n = 0
+        shift = np.mean(chunks[0], axis=1, keepdims=True)
+        for chunk in chunks:
+            chunk = chunk - shift
+            sum_x += np.sum(chunk, axis=1)
+            sum_xxt += chunk @ chunk.T
+            n += chunk.shape[1]
+        mean = sum_x / n
+        return sum_xxt / n - np.outer(mean, mean)
+
+
+def get_recording_statistics(recording, num_chunks=50, chunk_length=500, seed=0):
+    '''
+    Returns the RecordingStatistics of the recording extractor. The statistics are kept as long as the recording
+    extractor object exists, so that preprocessors estimating the same parameters from the data (e.g. whitening,
+    normalization, and saturation blanking) compute them only once.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor
+    num_chunks: int
+        Number of random chunks (default 50)
+    chunk_length: int
+        Number of frames of each random chunk (default 500)
+    seed: int
+        Random seed of the chunk positions (default 0)
+
+    Returns
+    -------
+    statistics: RecordingStatistics
+        The statistics of the recording
+    '''
+    key = (num_chunks, chunk_length, seed)
+    with _statistics_lock:
+        recording_statistics = _statistics.setdefault(recording, {})
+        statistics = recording_statistics.get(key)
+        if statistics is None:
+            statistics = RecordingStatistics(recording, num_chunks=num_chunks, chunk_length=chunk_length, seed=seed)
+            recording_statistics[key] = statistics
+    return statistics
+
+
+def get_cache_folder():
+    '''
+    Returns the folder where preprocessing parameters estimated from the data (e.g. whitening matrices) are cached.
+
+    Returns
+    -------
+    cache_folder: Path
+        The cache folder
+    '''
+    return Path(_cache_settings['cache_folder'])
+
+
+def set_cache_folder(cache_folder):
+    '''
+    Sets the folder where preprocessing parameters estimated from the data (e.g. whitening matrices) are cached.
+
+    Parameters
+    ----------
+    cache_folder: str or Path
+        The cache folder
+    '''
+    _cache_settings['cache_folder'] = Path(cache_folder)
+
+
+def _get_cache_file(name, fingerprint, params):
+    # file of the cache folder for the given recording fingerprint and parameters
+    key = hashlib.sha1(str((fingerprint, sorted(params.items()))).encode()).hexdigest()
+    return get_cache_folder() / f'{name}_{key}.npy'
+
+
+def _load_cached_array(name, fingerprint, params):
+    cache_file = _get_cache_file(name, fingerprint, params)
+    if cache_file.is_file():
+        try:
+            return np.load(str(cache_file))
+        except (OSError, ValueError):
+            return None
+    return None
+
+
+def _save_cached_array(name, fingerprint, params, array):
+    cache_file = _get_cache_file(name, fingerprint, params)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # written to a temporary file first, so that concurrent readers never see a partial file
+        tmp_file = cache_file.parent / (cache_file.stem + f'_{np.random.randint(1 << 30)}.tmp.npy')
+        np.save(str(tmp_file), array)
+        tmp_file.replace(cache_file)
+    except OSError:
+        # the cache is an optimization: failing to write it is not an error
+        pass
@@ -10,6 +10,7 @@ from .remove_bad_channels import remove_bad_channels, RemoveBadChannelsRecording
 from .normalize_by_quantile import normalize_by_quantile, NormalizeByQuantileRecording
 from .clip_traces import clip_traces, ClipTracesRecording
 from .blank_saturation import blank_saturation, BlankSaturationRecording
+from .read_ahead import read_ahead, ReadAheadRecording
 
 preprocessers_full_list = [
     BandpassFilterRecording,
@@ -23,7 +24,8 @@ preprocessers_full_list = [
     TransformTracesRecording,
     NormalizeByQuantileRecording,
     ClipTracesRecording,
-    BlankSaturationRecording
+    BlankSaturationRecording,
+    ReadAheadRecording
 ]
 
 installed_preprocessers_list = [pp for pp in preprocessers_full_list if pp.installed]
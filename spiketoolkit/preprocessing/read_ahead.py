@@ -0,0 +1,99 @@
+from spikeextractors import RecordingExtractor
+from .basepreprocessorrecording import BasePreprocessorRecording
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import weakref
+import numpy as np
+
+
+class ReadAheadRecording(BasePreprocessorRecording):
+
+    preprocessor_name = 'ReadAhead'
+    installed = True  # check at class level if installed or not
+    preprocessor_gui_params = []
+    installation_mesg = ""  # err
+
+    def __init__(self, recording):
+        if not isinstance(recording, RecordingExtractor):
+            raise ValueError("'recording' must be a RecordingExtractor")
+        self._recording = recording
+        self._executor = None
+        self._job = None
+        self._lock = threading.Lock()
+        BasePreprocessorRecording.__init__(self)
+        self.copy_channel_properties(recording=self._recording)
+
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
+        future = self._pop_job(channel_ids, start_frame, end_frame)
+        # the window following this one is read in the background while this one is consumed
+        num_frames = self.get_num_frames()
+        if end_frame < num_frames:
+            self._submit(channel_ids, end_frame, min(end_frame + (end_frame - start_frame), num_frames))
+        if future is not None and not future.cancelled():
+            return future.result()
+        return self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
+
+    def _submit(self, channel_ids, start_frame, end_frame):
+        key = (tuple(channel_ids), start_frame, end_frame)
+        with self._lock:
+            if self._job is not None:
+                if self._job[0] == key:
+                    return
+                self._job[1].cancel()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+                weakref.finalize(self, self._executor.shutdown, wait=False)
+            future = self._executor.submit(self._recording.get_traces, channel_ids=list(channel_ids),
+                                           start_frame=start_frame, end_frame=end_frame)
+            self._job = (key, future)
+
+    def _pop_job(self, channel_ids, start_frame, end_frame):
+        key = (tuple(channel_ids), start_frame, end_frame)
+        with self._lock:
+            if self._job is None or self._job[0] != key:
+                return None
+            future = self._job[1]
+            self._job = None
+        return future
+
+    def __getstate__(self):
+        # the read-ahead thread stays in the parent process
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_job'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def read_ahead(recording):
+    '''
+    Reads ahead the traces of the given recording extractor in a background thread.
+
+    After each get_traces call, the window of the same size that follows it is read in the background, so that
+    sequential scans (e.g. writing the recording to a binary file) overlap the reading and processing of the
+    next window with the consumption of the current one. The traces are unchanged.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to be read ahead
+    Returns
+    -------
+    read_ahead_recording: ReadAheadRecording
+        The read-ahead recording extractor object
+    '''
+    return ReadAheadRecording(
+        recording=recording
+    )
@@ -1,7 +1,8 @@
 from spikeextractors import RecordingExtractor
+from .basepreprocessorrecording import BasePreprocessorRecording
 import numpy as np
 
-class RemoveArtifactsRecording(RecordingExtractor):
+class RemoveArtifactsRecording(BasePreprocessorRecording):
 
     preprocessor_name = 'RemoveArtifacts'
     installed = True  # check at class level if installed or not
@@ -16,21 +17,18 @@ class RemoveArtifactsRecording(RecordingExtractor):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
         self._recording = recording
-        self._triggers = np.array(triggers)
+        self._triggers = np.sort(np.array(triggers, dtype='int64'))
         self._ms_before = ms_before
         self._ms_after = ms_after
-        RecordingExtractor.__init__(self)
+        pad = [int(self._ms_before * recording.get_sampling_frequency() / 1000),
+               int(self._ms_after * recording.get_sampling_frequency() / 1000)]
+        # the blanking intervals [trigger - pad before, trigger + pad after) are merged once: the merged intervals
+        # are disjoint, and both their starts and ends are sorted
+        self._interval_starts, self._interval_ends = _merge_intervals(self._triggers - pad[0],
+                                                                      self._triggers + pad[1])
+        BasePreprocessorRecording.__init__(self)
         self.copy_channel_properties(recording=self._recording)
 
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
-
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
         if start_frame is None:
             start_frame = 0
@@ -39,23 +37,45 @@ class RemoveArtifactsRecording(RecordingExtractor):
         if channel_ids is None:
             channel_ids = self.get_channel_ids()
         traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
-        triggers = self._triggers[(self._triggers > start_frame) & (self._triggers < end_frame)] - start_frame
+        return self._remove_artifacts(traces, start_frame)
 
-        pad = [int(self._ms_before * self.get_sampling_frequency() / 1000),
-               int(self._ms_after * self.get_sampling_frequency() / 1000)]
+    def _get_pipeline_margin(self):
+        return 0
 
-        for trig in triggers:
-            if trig - pad[0] > 0 and trig + pad[1] < end_frame - start_frame:
-                traces[:, trig - pad[0]:trig + pad[1]] = 0
-            elif trig - pad[0] <= 0 and trig + pad[1] >= end_frame - start_frame:
-                traces = 0
-            elif trig - pad[0] <= 0:
-                traces[:, :trig + pad[1]] = 0
-            elif trig + pad[1] >= end_frame - start_frame:
-                traces[:, trig - pad[0]:] = 0
+    def _process_pipeline_chunk(self, traces, start_frame, margin):
+        return self._remove_artifacts(traces, start_frame)
+
+    def _remove_artifacts(self, traces, start_frame):
+        end_frame = start_frame + traces.shape[1]
+        # intervals overlapping the window
+        i1 = np.searchsorted(self._interval_ends, start_frame, side='right')
+        i2 = np.searchsorted(self._interval_starts, end_frame, side='left')
+        if i2 <= i1:
+            return traces
+        starts = np.clip(self._interval_starts[i1:i2] - start_frame, 0, traces.shape[1])
+        ends = np.clip(self._interval_ends[i1:i2] - start_frame, 0, traces.shape[1])
+        # the intervals are disjoint: the mask is 1 between each start and the following end
+        mask = np.zeros(traces.shape[1] + 1, dtype='int8')
+        np.add.at(mask, starts, 1)
+        np.add.at(mask, ends, -1)
+        traces[:, np.cumsum(mask[:-1]) > 0] = 0
         return traces
 
 
+def _merge_intervals(starts, ends):
+    # merges the overlapping (or adjacent) intervals [starts, ends), sorted by start
+    if len(starts) == 0:
+        return np.array([], dtype='int64'), np.array([], dtype='int64')
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = np.maximum.accumulate(ends[order])
+    # a new interval begins where the start is after the end of all the previous ones
+    new = np.concatenate([[True], starts[1:] > ends[:-1]])
+    merged_starts = starts[new]
+    merged_ends = np.concatenate([ends[np.nonzero(new)[0][1:] - 1], [ends[-1]]])
+    return merged_starts, merged_ends
+
+
 def remove_artifacts(recording, triggers, ms_before=0.5, ms_after=3):
     '''
     Removes stimulation artifacts from recording extractor traces. Artifact periods are zeroed-out.
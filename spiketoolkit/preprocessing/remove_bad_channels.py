@@ -1,7 +1,10 @@
 from spikeextractors import RecordingExtractor, SubRecordingExtractor
+from .basepreprocessorrecording import BasePreprocessorRecording
+from .preprocessing_tools import get_recording_fingerprint, _load_cached_array, _save_cached_array
+from joblib import Parallel, delayed
 import numpy as np
 
-class RemoveBadChannelsRecording(RecordingExtractor):
+class RemoveBadChannelsRecording(BasePreprocessorRecording):
 
     preprocessor_name = 'RemoveBadChannels'
     installed = True  # check at class level if installed or not
@@ -10,29 +13,47 @@ class RemoveBadChannelsRecording(RecordingExtractor):
         {'name': 'bad_threshold', 'type': 'float', 'title': "Threshold in number of sd to remove channels (when automatic)"},
         {'name': 'seconds', 'type': 'float', 'title': "Number of seconds to compute standard deviation (when automatic)"},
         {'name': 'verbose', 'type': 'bool', 'title': "If True output is verbose"},
+        {'name': 'method', 'type': 'str', 'value': 'std', 'default': 'std', 'title':
+            "Criterion for the automatic removal ('std', 'mad', or 'coherence')"},
+        {'name': 'num_windows', 'type': 'int', 'value': 10, 'default': 10, 'title':
+            "Number of windows, spread over the recording, used for the automatic removal"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of threads reading the windows"},
+        {'name': 'max_memory', 'type': 'int', 'value': 500 * 1024 ** 2, 'default': 500 * 1024 ** 2, 'title':
+            "Maximum memory (in bytes) of the windows read at the same time"},
+        {'name': 'cache_mask', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True the automatically detected bad channels are cached on disk"},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, bad_channel_ids, bad_threshold, seconds, verbose):
+    def __init__(self, recording, bad_channel_ids, bad_threshold, seconds, verbose, method='std', num_windows=10,
+                 n_jobs=1, max_memory=500 * 1024 ** 2, cache_mask=False):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
+        if method not in ['std', 'mad', 'coherence']:
+            raise ValueError("'method' must be 'std', 'mad', or 'coherence'")
         self._recording = recording
         self._bad_channel_ids = bad_channel_ids
         self._bad_threshold = bad_threshold
         self._seconds = seconds
+        self._method = method
+        self._num_windows = num_windows
+        self._n_jobs = n_jobs
+        self._max_memory = max_memory
+        self._cache_mask = cache_mask
         self.verbose = verbose
         self._initialize_subrecording_extractor()
-        RecordingExtractor.__init__(self)
+        BasePreprocessorRecording.__init__(self)
         self.copy_channel_properties(recording=self._subrecording)
 
     def get_sampling_frequency(self):
-        return self._subrecording.get_sampling_frequency()
+        return self._get_metadata('sampling_frequency', self._subrecording.get_sampling_frequency)
 
     def get_num_frames(self):
-        return self._subrecording.get_num_frames()
+        return self._get_metadata('num_frames', self._subrecording.get_num_frames)
 
     def get_channel_ids(self):
-        return self._subrecording.get_channel_ids()
+        return self._get_metadata('channel_ids', lambda: list(self._subrecording.get_channel_ids()))
 
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
         if start_frame is None:
@@ -52,11 +73,8 @@ class RemoveBadChannelsRecording(RecordingExtractor):
                     active_channels.append(chan)
             self._subrecording = SubRecordingExtractor(self._recording, channel_ids=active_channels)
         elif self._bad_channel_ids is None:
-            start_frame = self._recording.get_num_frames() // 2
-            end_frame = int(start_frame + self._seconds * self._recording.get_sampling_frequency())
-            traces = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-            stds = np.std(traces, axis=1)
-            bad_channel_ids = [ch for ch, std in enumerate(stds) if std > self._bad_threshold * np.median(stds)]
+            channel_ids = self._recording.get_channel_ids()
+            bad_channel_ids = [channel_ids[i] for i in self._detect_bad_channels()]
             if self.verbose:
                 print('Automatically removing channels:', bad_channel_ids)
             active_channels = []
@@ -68,8 +86,64 @@ class RemoveBadChannelsRecording(RecordingExtractor):
             self._subrecording = self._recording
         self.active_channels = self._subrecording.get_channel_ids()
 
+    def _detect_bad_channels(self):
+        # indices of the bad channels, cached on disk for the recording and the detection parameters
+        if self._cache_mask:
+            fingerprint = get_recording_fingerprint(self._recording)
+            params = dict(method=self._method, bad_threshold=self._bad_threshold, seconds=self._seconds,
+                          num_windows=self._num_windows)
+            bad_channel_indices = _load_cached_array('bad_channels', fingerprint, params)
+            if bad_channel_indices is None:
+                bad_channel_indices = self._compute_bad_channels()
+                _save_cached_array('bad_channels', fingerprint, params, bad_channel_indices)
+            return bad_channel_indices
+        return self._compute_bad_channels()
 
-def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, seconds=10, verbose=False):
+    def _compute_bad_channels(self):
+        N = self._recording.get_num_frames()
+        M = len(self._recording.get_channel_ids())
+        # the sampled seconds are split in short windows spread over the recording
+        window_frames = int(self._seconds * self._recording.get_sampling_frequency() / self._num_windows)
+        window_frames = min(max(window_frames, 1), N)
+        starts = np.unique(np.linspace(0, N - window_frames, self._num_windows).astype(int))
+        # the number of windows read at the same time is bounded by the memory budget
+        window_bytes = M * window_frames * 8
+        n_jobs = max(1, min(self._n_jobs, self._max_memory // window_bytes))
+        if n_jobs == 1:
+            values = [self._get_window_values(start, start + window_frames) for start in starts]
+        else:
+            values = Parallel(n_jobs=n_jobs, prefer='threads')(
+                delayed(self._get_window_values)(start, start + window_frames) for start in starts)
+        # the median over the windows is robust to transients in a few of them
+        values = np.median(np.array(values), axis=0)
+        if self._method == 'coherence':
+            # channels much less correlated to the others than the typical channel
+            bad = values < np.median(values) / self._bad_threshold
+        else:
+            bad = values > self._bad_threshold * np.median(values)
+        return np.nonzero(bad)[0]
+
+    def _get_window_values(self, start_frame, end_frame):
+        # value of the bad channel criterion of each channel in a window
+        traces = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame).astype('float64')
+        if self._method == 'std':
+            return np.std(traces, axis=1)
+        elif self._method == 'mad':
+            return np.median(np.abs(traces - np.median(traces, axis=1, keepdims=True)), axis=1) / 0.6745
+        else:
+            # correlation of each channel with the median of all channels
+            reference = np.median(traces, axis=0)
+            traces -= np.mean(traces, axis=1, keepdims=True)
+            reference -= np.mean(reference)
+            norms = np.linalg.norm(traces, axis=1) * np.linalg.norm(reference)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                coherence = traces @ reference / norms
+            # flat channels have no correlation
+            return np.nan_to_num(coherence)
+
+
+def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, seconds=10, verbose=False, method='std',
+                        num_windows=10, n_jobs=1, max_memory=500 * 1024 ** 2, cache_mask=False):
     '''
     Remove bad channels from the recording extractor.
 
@@ -81,10 +155,29 @@ def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, second
         List of bad channel ids (int). If None, automatic removal will be done based on standard deviation.
     bad_threshold: float
         If automatic is used, the threshold for the standard deviation over which channels are removed
+        (in number of times the median over channels). With the 'coherence' method, channels whose coherence
+        is below the median coherence divided by bad_threshold are removed.
     seconds: float
-        If automatic is used, the number of seconds used to compute standard deviations
+        If automatic is used, the number of seconds used to compute standard deviations. They are split in
+        num_windows windows evenly spread over the recording.
     verbose: bool
         If True, output is verbose
+    method: str
+        Criterion of the automatic removal (default 'std'):
+        'std': standard deviation of the channels.
+        'mad': median absolute deviation of the channels, robust to spikes and short artifacts.
+        'coherence': correlation of each channel with the median of all channels, which detects dead and
+        disconnected channels.
+        The criterion is computed in each window, and its median over windows is used.
+    num_windows: int
+        Number of windows used for the automatic removal (default 10).
+    n_jobs: int
+        Number of threads reading the windows (default 1).
+    max_memory: int
+        Maximum memory in bytes of the windows read in parallel (default 500 MB).
+    cache_mask: bool
+        If True, the automatically detected bad channels are cached on disk for the recording and the detection
+        parameters (see get_recording_fingerprint), so that they are not computed again (default False).
 
     Returns
     -------
@@ -93,4 +186,6 @@ def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, second
 
     '''
     return RemoveBadChannelsRecording(recording=recording, bad_channel_ids=bad_channel_ids,
-                                      bad_threshold=bad_threshold, seconds=seconds, verbose=verbose)
+                                      bad_threshold=bad_threshold, seconds=seconds, verbose=verbose, method=method,
+                                      num_windows=num_windows, n_jobs=n_jobs, max_memory=max_memory,
+                                      cache_mask=cache_mask)
@@ -1,4 +1,6 @@
-from spikeextractors import RecordingExtractor
+from .basepreprocessorrecording import BasePreprocessorRecording
+from fractions import Fraction
+import warnings
 import numpy as np
 
 try:
@@ -7,64 +9,96 @@ try:
 except ImportError:
     HAVE_RR = False
 
-class ResampleRecording(RecordingExtractor):
+# largest up and down factors of the exact resampling ratio (the anti-aliasing filter has 20 * max(up, down) taps)
+_max_resample_factor = 10000
+
+
+class ResampleRecording(BasePreprocessorRecording):
 
     preprocessor_name = 'Resample'
     installed = HAVE_RR  # check at class level if installed or not
     preprocessor_gui_params = [
         {'name': 'resample_rate', 'type': 'float', 'title': "The resampling frequency"},
+        {'name': 'chunk_size', 'type': 'int', 'value': 30000, 'default': 30000, 'title':
+            "Chunk size (in resampled frames) for the resampling"},
     ]
     installation_mesg = "To use the ResampleRecording, install scipy: \n\n pip install scipy\n\n"  # err
 
 
-    def __init__(self, recording, resample_rate):
+    def __init__(self, recording, resample_rate, chunk_size=30000):
         assert HAVE_RR, "To use the ResampleRecording, install scipy: \n\n pip install scipy\n\n"
         self._recording = recording
         self._resample_rate = resample_rate
-        RecordingExtractor.__init__(self)
+        self._chunk_size = chunk_size
+        # rational resampling factor up / down, from the decimal values of the rates
+        ratio = Fraction(str(float(resample_rate))) / Fraction(str(float(recording.get_sampling_frequency())))
+        if ratio <= 0:
+            raise ValueError("'resample_rate' must be positive")
+        if max(ratio.numerator, ratio.denominator) > _max_resample_factor:
+            ratio = ratio.limit_denominator(1000)
+            warnings.warn(f"The resampling ratio is approximated by {ratio.numerator} / {ratio.denominator}: the "
+                          f"effective sampling frequency is "
+                          f"{float(recording.get_sampling_frequency() * ratio)} instead of {resample_rate}")
+        self._up = ratio.numerator
+        self._down = ratio.denominator
+        # same anti-aliasing filter as scipy resample_poly, designed once
+        max_rate = max(self._up, self._down)
+        half_len = 10 * max_rate
+        self._h = signal.firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0))
+        # input frames on each side of a window that the filter reaches
+        self._margin = half_len // self._up + 2
+        BasePreprocessorRecording.__init__(self)
         self.copy_channel_properties(recording)
 
     def get_sampling_frequency(self):
-        return self._resample_rate
+        # the effective rate, which differs from resample_rate if the fraction up / down approximates it
+        return self._get_metadata('sampling_frequency',
+                                  lambda: float(self._recording.get_sampling_frequency() * self._up / self._down))
 
     def get_num_frames(self):
-        return int(self._recording.get_num_frames() / self._recording.get_sampling_frequency() * self._resample_rate)
+        return self._get_metadata('num_frames', lambda: self._get_input_num_frames() * self._up // self._down)
 
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
         if start_frame is None:
-            start_frame_not_sampled = 0
-            start_frame_sampled = 0
-        else:
-            start_frame_not_sampled = int(start_frame / self.get_sampling_frequency() *
-                                          self._recording.get_sampling_frequency())
-            start_frame_sampled = start_frame
+            start_frame = 0
         if end_frame is None:
-            end_frame_not_sampled = self._recording.get_num_frames()
-            end_frame_sampled = self.get_num_frames()
-        else:
-            end_frame_not_sampled = int(end_frame / self.get_sampling_frequency() * self._recording.get_sampling_frequency())
-            end_frame_sampled = end_frame
+            end_frame = self.get_num_frames()
         if channel_ids is None:
             channel_ids = self.get_channel_ids()
-        traces = self._recording.get_traces(start_frame=start_frame_not_sampled,
-                                           end_frame=end_frame_not_sampled,
-                                           channel_ids=channel_ids)
-        if np.mod(self._recording.get_sampling_frequency(), self._resample_rate) == 0:
-            traces_resampled = signal.decimate(traces,
-                                               q=int(self._recording.get_sampling_frequency() / self._resample_rate),
-                                               axis=1)
-        else:
-            traces_resampled = signal.resample(traces, int(end_frame_sampled - start_frame_sampled), axis=1)
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
+        if self._chunk_size is None:
+            return self._resample_chunk(channel_ids, start_frame, end_frame)
+        traces_resampled = np.zeros((len(channel_ids), end_frame - start_frame), dtype='float64')
+        for start in range(start_frame, end_frame, self._chunk_size):
+            end = min(start + self._chunk_size, end_frame)
+            traces_resampled[:, start - start_frame:end - start_frame] = self._resample_chunk(channel_ids, start, end)
         return traces_resampled
 
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
+    def _resample_chunk(self, channel_ids, start_frame, end_frame):
+        # input window with margins, starting at a multiple of down: resampling it gives the same samples as
+        # resampling the full recording (which is zero-padded at its edges), shifted by i1 * up / down
+        i1 = (start_frame * self._down // self._up - self._margin) // self._down * self._down
+        i2 = -(-end_frame * self._down // self._up) + self._margin
+        N = self._get_input_num_frames()
+        i1b = max(i1, 0)
+        i2b = min(i2, N)
+        traces = np.zeros((len(channel_ids), i2 - i1), dtype='float64')
+        if i2b > i1b:
+            traces[:, i1b - i1:i2b - i1] = self._recording.get_traces(channel_ids=channel_ids, start_frame=i1b,
+                                                                       end_frame=i2b)
+        traces_resampled = signal.resample_poly(traces, self._up, self._down, axis=1, window=self._h)
+        offset = i1 * self._up // self._down
+        return traces_resampled[:, start_frame - offset:end_frame - offset]
 
 
-def resample(recording, resample_rate):
+def resample(recording, resample_rate, chunk_size=30000):
     '''
-    Resamples the recording extractor traces. If the resampling rate is multiple of the sampling rate, the faster
-    scipy decimate function is used.
+    Resamples the recording extractor traces with a polyphase filter (scipy resample_poly). The ratio between the
+    resampling and the sampling rate is the exact fraction up / down of their decimal values if up and down are at
+    most 10000; otherwise it is approximated with down up to 1000 and a warning gives the effective sampling
+    frequency. Traces are resampled in chunks, each read with a margin covering the length of the anti-aliasing
+    filter, so that any window is identical to the corresponding samples of the full resampled recording.
 
     Parameters
     ----------
@@ -72,6 +106,9 @@ def resample(recording, resample_rate):
         The recording extractor to be resampled
     resample_rate: int or float
         The resampling frequency
+    chunk_size: int or None
+        Number of resampled frames processed at once (default 30000). If None, the requested window is resampled
+        at once.
 
     Returns
     -------
@@ -81,5 +118,6 @@ def resample(recording, resample_rate):
     '''
     return ResampleRecording(
         recording=recording,
-        resample_rate=resample_rate
+        resample_rate=resample_rate,
+        chunk_size=chunk_size
     )
@@ -1,7 +1,7 @@
-from spikeextractors import RecordingExtractor
+from .elementwise import ElementwiseRecording
 import numpy as np
 
-class TransformTracesRecording(RecordingExtractor):
+class TransformTracesRecording(ElementwiseRecording):
 
     preprocessor_name = 'TransformTraces'
     installed = True  # check at class level if installed or not
@@ -12,32 +12,17 @@ class TransformTracesRecording(RecordingExtractor):
     installation_mesg = ""  # err
 
     def __init__(self, recording, scalar=1, offset=0):
-        if not isinstance(recording, RecordingExtractor):
-            raise ValueError("'recording' must be a RecordingExtractor")
-        self._recording = recording
         self._scalar = scalar
         self._offset = offset
-        RecordingExtractor.__init__(self)
-        self.copy_channel_properties(recording=self._recording)
-
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
-
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = self.get_num_frames()
-        if channel_ids is None:
-            channel_ids = self.get_channel_ids()
-        traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
-        return traces*self._scalar + self._offset
+        ElementwiseRecording.__init__(self, recording)
+
+    def _get_output_dtype(self, dtype):
+        return (np.zeros(1, dtype=dtype) * self._scalar + self._offset).dtype
+
+    def _apply(self, traces):
+        traces *= self._scalar
+        traces += self._offset
+        return traces
 
 
 def transform_traces(recording, scalar=1, offset=0):
@@ -1,6 +1,14 @@
 from .filterrecording import FilterRecording
+from .preprocessing_tools import get_recording_fingerprint, get_recording_statistics, _load_cached_array, \
+    _save_cached_array
 import numpy as np
 
+try:
+    import scipy.sparse as sparse
+    HAVE_SPARSE = True
+except ImportError:
+    HAVE_SPARSE = False
+
 
 class WhitenRecording(FilterRecording):
 
@@ -11,55 +19,137 @@ class WhitenRecording(FilterRecording):
             "Chunk size for the filter."},
         {'name': 'cache_chunks', 'type': 'bool', 'value': False, 'default': False, 'title':
             "If True filtered traces are computed and cached"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of parallel jobs used to filter the chunks of a get_traces call"},
+        {'name': 'backend', 'type': 'str', 'value': 'thread', 'default': 'thread', 'title':
+            "Parallel backend for the chunks ('thread' or 'process')"},
+        {'name': 'read_ahead', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True the next chunk is filtered in a background thread during sequential reads"},
          {'name': 'seed', 'type': 'int', 'value': 0, 'default': 0, 
           'title': "Random seed for reproducibility."},
+        {'name': 'num_chunks', 'type': 'int', 'value': 50, 'default': 50, 'title':
+            "Number of random chunks used to estimate the covariance"},
+        {'name': 'chunk_length', 'type': 'int', 'value': 500, 'default': 500, 'title':
+            "Number of frames of the random chunks used to estimate the covariance"},
+        {'name': 'eps', 'type': 'float', 'value': 0, 'default': 0, 'title':
+            "Regularization added to the eigenvalues of the covariance"},
+        {'name': 'cache_matrix', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True the whitening matrix is cached on disk"},
+        {'name': 'mode', 'type': 'str', 'value': 'global', 'default': 'global', 'title':
+            "'global' or 'local'. If 'local' each channel is whitened with its neighbors within 'radius'"},
+        {'name': 'radius', 'type': 'float', 'value': 100, 'default': 100, 'title':
+            "Radius of the neighborhoods used by the 'local' mode (in the units of the channel locations)"},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, chunk_size=30000, cache_chunks=False, seed=0):
+    def __init__(self, recording, chunk_size=30000, cache_chunks=False, seed=0, n_jobs=1, backend='thread',
+                 read_ahead=False, num_chunks=50, chunk_length=500, eps=0, cache_matrix=False, mode='global',
+                 radius=100):
+        if mode not in ['global', 'local']:
+            raise ValueError("'mode' must be 'global' or 'local'")
+        if mode == 'local':
+            assert HAVE_SPARSE, "To use the 'local' whitening, install scipy: \n\n pip install scipy\n\n"
         self._recording = recording
-        self._whitening_matrix = self._compute_whitening_matrix(seed=seed)
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
-
-    def _get_random_data_for_whitening(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in random_ints:
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
+        self._num_chunks = num_chunks
+        self._chunk_length = chunk_length
+        self._eps = eps
+        self._mode = mode
+        self._radius = radius
+        if mode == 'local':
+            self._neighbors = self._compute_neighbors()
+        if cache_matrix:
+            # the matrix only depends on the data and on the estimation parameters
+            fingerprint = get_recording_fingerprint(recording)
+            params = dict(seed=seed, num_chunks=num_chunks, chunk_length=chunk_length, eps=eps, mode=mode)
+            if mode == 'local':
+                params['radius'] = radius
+            self._whitening_matrix = _load_cached_array('whitening', fingerprint, params)
+            if self._whitening_matrix is None:
+                self._whitening_matrix = self._compute_whitening_matrix(seed=seed)
+                _save_cached_array('whitening', fingerprint, params, self._whitening_matrix)
+        else:
+            self._whitening_matrix = self._compute_whitening_matrix(seed=seed)
+        if mode == 'local':
+            # the matrix has one non-zero per neighbor pair: it is applied as a sparse operator
+            self._whitening_matrix = sparse.csr_matrix(self._whitening_matrix)
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 n_jobs=n_jobs, backend=backend,
+                                 read_ahead=read_ahead)
+
+    def _compute_covariance(self, seed):
+        return get_recording_statistics(self._recording, num_chunks=self._num_chunks,
+                                        chunk_length=self._chunk_length, seed=seed).get_covariance()
+
+    def _compute_neighbors(self):
+        # sorted indices of the channels within radius of each channel (itself included)
+        try:
+            locations = np.array(self._recording.get_channel_locations(), dtype='float64')
+        except Exception:
+            raise ValueError("The 'local' whitening needs the 'location' property of the channels")
+        return [np.nonzero(np.linalg.norm(locations - loc, axis=1) <= self._radius)[0] for loc in locations]
 
     def _compute_whitening_matrix(self, seed):
-        data = self._get_random_data_for_whitening(seed=seed)
-        
-        # center the data
-        data = data - np.mean(data, axis=1, keepdims=True)
-        
-        # Original by Jeremy
-        AAt = data @ np.transpose(data)
-        AAt = AAt / data.shape[1]
-        U, S, Ut = np.linalg.svd(AAt, full_matrices=True)
-        W = (U @ np.diag(1 / np.sqrt(S))) @ Ut
-        
-        # proposed by Alessio
-        # AAt = data @ data.T / data.shape[1]
-        # D, V = np.linalg.eig(AAt)
-        # W = np.dot(np.diag(1.0 / np.sqrt(D + 1e-10)), V)
-        
+        AAt = self._compute_covariance(seed=seed)
+        if self._mode == 'global':
+            return _get_whitening(AAt, self._eps)
+        # each channel is whitened with the covariance of its neighborhood: row i of W is the row of channel i
+        # in the whitening matrix of its neighbors
+        W = np.zeros(AAt.shape)
+        for i, neighbors in enumerate(self._neighbors):
+            W_local = _get_whitening(AAt[np.ix_(neighbors, neighbors)], self._eps)
+            W[i, neighbors] = W_local[np.searchsorted(neighbors, i)]
         return W
 
-    def filter_chunk(self, *, start_frame, end_frame):
-        chunk = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-        chunk = chunk - np.mean(chunk, axis=1, keepdims=True)
-        chunk2 = self._whitening_matrix @ chunk
+    def _get_pipeline_margin(self):
+        return 0
+
+    def _process_pipeline_chunk(self, traces, start_frame, margin):
+        # the mean of the output chunk, without the margins, as in filter_chunk
+        traces -= np.mean(traces[:, margin:traces.shape[1] - margin], axis=1, keepdims=True)
+        return self._whitening_matrix @ traces
+
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        if channel_ids is None:
+            chunk = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
+            chunk = chunk - np.mean(chunk, axis=1, keepdims=True)
+            chunk2 = self._whitening_matrix @ chunk
+        elif self._mode == 'global':
+            # all channels are needed, but only the requested rows of the whitening matrix are applied
+            chunk = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
+            chunk = chunk - np.mean(chunk, axis=1, keepdims=True)
+            channel_index = self.get_channel_index()
+            chan_idx = [channel_index[chan] for chan in channel_ids]
+            chunk2 = self._whitening_matrix[chan_idx] @ chunk
+        else:
+            # only the neighbors of the requested channels are read
+            channel_index = self.get_channel_index()
+            chan_idx = [channel_index[chan] for chan in channel_ids]
+            W = self._whitening_matrix[chan_idx]
+            cols = np.unique(W.indices)
+            parent_ids = self.get_channel_ids()
+            chunk = self._recording.get_traces(channel_ids=[parent_ids[c] for c in cols], start_frame=start_frame,
+                                               end_frame=end_frame)
+            chunk = chunk - np.mean(chunk, axis=1, keepdims=True)
+            chunk2 = W[:, cols] @ chunk
         return chunk2
 
 
-def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
+def _get_whitening(cov, eps=0):
+    # the covariance is symmetric: W = U diag(1 / sqrt(S + eps)) U^T
+    S, U = np.linalg.eigh(cov)
+    # a rank-deficient covariance (e.g. after a common average reference) has zero or slightly negative eigenvalues:
+    # they are floored relative to the largest one, so that the matrix stays finite even with eps=0
+    S = np.maximum(S, max(S.max(), 0) * 1e-10)
+    return (U * (1 / np.sqrt(S + eps))) @ U.T
+
+
+def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0, n_jobs=1, backend='thread', read_ahead=False,
+           num_chunks=50, chunk_length=500, eps=0, cache_matrix=False, mode='global', radius=100):
     '''
-    Whitens the recording extractor traces.
+    Whitens the recording extractor traces. The whitening matrix is computed from the covariance of random chunks of
+    the recording, accumulated chunk by chunk. If cache_matrix is True, it is saved in the preprocessing cache folder
+    (see set_cache_folder), keyed by the fingerprint of the recording and the estimation parameters, so that
+    whitening the same recording again does not read its data.
 
     Parameters
     ----------
@@ -67,10 +157,35 @@ def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
         The recording extractor to be whitened.
     chunk_size: int
         The chunk size to be used for the filtering.
-    cache_chunks: bool
-        If True, filtered traces are computed and cached all at once (default False).
+    cache_chunks: bool, 'global', or FilteredChunkCache
+        If True, whitened chunks are cached in memory (default False). If 'global' the process-wide chunk cache is
+        used. A FilteredChunkCache can be passed to share the same cache among several extractors, or to set its
+        budget and on-disk tier.
     seed: int
         Random seed for reproducibility
+    n_jobs: int
+        Number of jobs used to filter in parallel the chunks spanned by a get_traces call (default 1).
+    backend: str
+        'thread' or 'process'. Pool used when n_jobs is not 1 (default 'thread').
+    read_ahead: bool
+        If True, while a chunk is consumed the next one is filtered in a background thread, so that sequential
+        reads (e.g. writing to a binary file) overlap reading and filtering (default False).
+    num_chunks: int
+        Number of random chunks used to estimate the covariance (default 50).
+    chunk_length: int
+        Number of frames of each random chunk (default 500).
+    eps: float
+        Regularization added to the eigenvalues of the covariance, which avoids amplifying the noise of
+        (nearly) singular directions, e.g. of dead or duplicated channels (default 0).
+    cache_matrix: bool
+        If True, the whitening matrix is cached on disk and reused (default False).
+    mode: str
+        'global' or 'local'. If 'global', all channels are whitened together with a dense matrix. If 'local', each
+        channel is whitened with the channels within 'radius' from it (from the 'location' property): the matrix is
+        sparse and the cost scales with the size of the neighborhoods instead of the number of channels
+        (default 'global').
+    radius: float
+        Radius of the neighborhoods for the 'local' mode, in the units of the channel locations (default 100).
     Returns
     -------
     whitened_recording: WhitenRecording
@@ -81,5 +196,14 @@ def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
         recording=recording,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
-        seed=seed
+        seed=seed,
+        n_jobs=n_jobs,
+        backend=backend,
+        read_ahead=read_ahead,
+        num_chunks=num_chunks,
+        chunk_length=chunk_length,
+        eps=eps,
+        cache_matrix=cache_matrix,
+        mode=mode,
+        radius=radius
     )
@@ -1,15 +1,33 @@
 import scipy.signal as ss
 import numpy as np
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 import spikeextractors as se
 import itertools
-import numpy as np
+from ..preprocessing import get_recording_statistics
+from ..preprocessing.basepreprocessorrecording import _get_channel_index
+
+# half width (in samples) of the Lanczos kernel of the sinc interpolation
+_sinc_half_width = 4
+# number of time ranges per job in the 'time' parallel mode, for load balancing
+_ranges_per_job = 4
 
 
 def detect_spikes(recording, channel_ids=None, detect_threshold=5, n_pad_ms=2, upsample=1, detect_sign=-1,
-                  min_diff_samples=5, parallel=False, n_jobs=-1):
+                  min_diff_samples=5, parallel=False, n_jobs=-1, chunk_size=30000, noise_num_chunks=50,
+                  noise_chunk_size=500, seed=0, interpolation='parabolic', method='by_channel', radius=50,
+                  parallel_mode='time'):
     '''
-    Detects spikes per channel.
+    Detects spikes per channel ('by_channel' method) or on all channels at once ('locally_exclusive' method).
+
+    With the 'by_channel' method, each channel is detected independently, so that a spike appears on all the
+    channels where it crosses the threshold. With the 'locally_exclusive' method, a spike is a peak of a channel which
+    is the largest within min_diff_samples frames on all the channels within 'radius' (from the 'location' property),
+    so that each spike is detected once, on its peak channel.
+
+    The recording is processed in chunks of 'chunk_size' frames, each read with a margin covering the alignment
+    window, so that memory is bounded by the chunk size whatever the recording length. The detection threshold is
+    estimated from the MAD of random chunks of the recording.
+
     Parameters
     ----------
     recording: RecordingExtractor
@@ -19,17 +37,40 @@ def detect_spikes(recording, channel_ids=None, detect_threshold=5, n_pad_ms=2, u
     detect_threshold: float
         Threshold in MAD to detect peaks
     n_pad_ms: float
-        Time in ms to find absolute peak around detected peak
+        Time in ms to find absolute peak around detected peak ('by_channel' method)
     upsample: int
-        The detected waveforms are upsampled 'upsample' times (default=1)
+        The peak times are refined to 1 / 'upsample' of a sample before being rounded down (default=1)
     detect_sign: int
         Sign of the detection: -1 (negative), 1 (positive), 0 (both)
     min_diff_samples: int
         Minimum interval to skip consecutive spikes (default=5)
     parallel: bool
-        If True, each channel is run in parallel
+        If True, the detection runs in parallel processes (see 'parallel_mode')
     n_jobs: int
         Number of jobs when parallel
+    chunk_size: int or None
+        Number of frames processed at once (default 30000). If None, the whole recording is processed at once
+    noise_num_chunks: int
+        Number of random chunks used to estimate the MAD (default 50)
+    noise_chunk_size: int
+        Number of frames of each random chunk used to estimate the MAD (default 500)
+    seed: int
+        Random seed of the chunks used to estimate the MAD (default 0)
+    interpolation: str
+        Refinement of the peak times when upsample > 1:
+            'parabolic': vertex of the parabola through the extremum and its two neighbors (default)
+            'sinc': extremum of the Lanczos (sinc) interpolation around the extremum
+            'fft': extremum of the alignment window upsampled with scipy resample ('by_channel' method)
+    method: str
+        'by_channel' (default) or 'locally_exclusive'
+    radius: float
+        Radius (in um) of the neighborhood of each channel for the 'locally_exclusive' method (default 50)
+    parallel_mode: str
+        'time' (default): contiguous time ranges of all channels are detected in parallel, each chunk by chunk. The
+        workers receive the recording extractor description and the range bounds only: preprocessors are pickled
+        without their caches, and in-memory traces are shared as memory maps.
+        'channels': each channel is detected in parallel ('by_channel' method)
+
     Returns
     -------
     sorting_detected: SortingExtractor
@@ -45,20 +86,41 @@ def detect_spikes(recording, channel_ids=None, detect_threshold=5, n_pad_ms=2, u
     else:
         assert np.all([ch in recording.get_channel_ids() for ch in channel_ids]), "Not all 'channel_ids' are in the" \
                                                                                   "recording."
+    if interpolation not in ['parabolic', 'sinc', 'fft']:
+        raise ValueError("'interpolation' must be 'parabolic', 'sinc', or 'fft'")
+    if method not in ['by_channel', 'locally_exclusive']:
+        raise ValueError("'method' must be 'by_channel' or 'locally_exclusive'")
+    if method == 'locally_exclusive' and interpolation == 'fft':
+        raise ValueError("The 'locally_exclusive' method supports the 'parabolic' and 'sinc' interpolations")
+    if parallel_mode not in ['time', 'channels']:
+        raise ValueError("'parallel_mode' must be 'time' or 'channels'")
+    if method == 'locally_exclusive' and parallel and parallel_mode == 'channels':
+        raise ValueError("The 'locally_exclusive' method runs in parallel with the 'time' parallel mode")
+    thresholds = detect_threshold * _get_noise_levels(recording, channel_ids, noise_num_chunks, noise_chunk_size,
+                                                      seed)
+
+    if method == 'locally_exclusive':
+        neighbors = _get_neighbors(recording, channel_ids, radius)
+    else:
+        neighbors = None
 
-    if parallel:
-        output = Parallel(n_jobs=n_jobs)(delayed(_detect_and_align_peaks_single_channel)
-                                         (recording, ch, detect_threshold, detect_sign,
-                                          n_pad_samples, upsample, min_diff_samples) for ch in channel_ids)
-        for o in output:
-            spike_times.append(o[0])
-            labels.append(o[1])
+    if parallel and parallel_mode == 'time':
+        peak_times = _detect_and_align_peaks_parallel(recording, channel_ids, thresholds, detect_sign, n_pad_samples,
+                                                      upsample, min_diff_samples, chunk_size, n_jobs,
+                                                      interpolation=interpolation, neighbors=neighbors)
+    elif parallel:
+        output = Parallel(n_jobs=n_jobs)(delayed(_detect_and_align_peaks)
+                                         (recording, [ch], [thresh], detect_sign, n_pad_samples, upsample,
+                                          min_diff_samples, chunk_size, interpolation=interpolation)
+                                         for ch, thresh in zip(channel_ids, thresholds))
+        peak_times = [o[0] for o in output]
     else:
-        for ch in channel_ids:
-            peak_times, label = _detect_and_align_peaks_single_channel(recording, ch, detect_threshold, detect_sign,
-                                                                       n_pad_samples, upsample, min_diff_samples)
-            spike_times.append(peak_times)
-            labels.append(label)
+        peak_times = _detect_and_align_peaks(recording, channel_ids, thresholds, detect_sign, n_pad_samples,
+                                             upsample, min_diff_samples, chunk_size, interpolation=interpolation,
+                                             neighbors=neighbors)
+    for ch, sp_times in zip(channel_ids, peak_times):
+        spike_times.append(sp_times)
+        labels.append([ch] * len(sp_times))
 
     # create sorting extractor
     sorting = se.NumpySortingExtractor()
@@ -72,55 +134,220 @@ def detect_spikes(recording, channel_ids=None, detect_threshold=5, n_pad_ms=2, u
     return sorting
 
 
-def _detect_and_align_peaks_single_channel(recording, channel, n_std, detect_sign, n_pad, upsample, min_diff_samples):
-    trace = np.squeeze(recording.get_traces(channel_ids=channel))
+def _get_noise_levels(recording, channel_ids, num_chunks, chunk_size, seed):
+    # MAD of each channel (around 0), estimated from random chunks instead of the full traces
+    sample = get_recording_statistics(recording, num_chunks=num_chunks, chunk_length=chunk_size,
+                                      seed=seed).get_sample()
+    channel_index = _get_channel_index(recording)
+    sample = sample[[channel_index[ch] for ch in channel_ids]]
+    return np.median(np.abs(sample), axis=1) / 0.6745
+
+
+def _get_neighbors(recording, channel_ids, radius):
+    # neighbor table: row i holds the indices of the channels within radius of channel i (itself included),
+    # padded with -1
+    try:
+        locations = np.array(recording.get_channel_locations(channel_ids=channel_ids), dtype='float64')
+    except Exception:
+        raise ValueError("The 'locally_exclusive' method needs the 'location' property of the channels")
+    distances = np.linalg.norm(locations[:, np.newaxis] - locations[np.newaxis], axis=2)
+    is_neighbor = distances <= radius
+    num_neighbors = np.sum(is_neighbor, axis=1)
+    neighbors = -np.ones((len(channel_ids), np.max(num_neighbors)), dtype=int)
+    for i in range(len(channel_ids)):
+        neighbors[i, :num_neighbors[i]] = np.nonzero(is_neighbor[i])[0]
+    return neighbors
+
+
+def _read_traces(recording, channel_ids, i1, i2, num_frames):
+    # reads frames [i1, i2), zero-padded outside of the recording
+    i1b = max(i1, 0)
+    i2b = min(i2, num_frames)
+    traces = recording.get_traces(channel_ids=channel_ids, start_frame=i1b, end_frame=i2b)
+    if i1b > i1 or i2b < i2:
+        traces = np.pad(traces, ((0, 0), (i1b - i1, i2 - i2b)), 'constant')
+    return traces
+
+
+def _detect_and_align_peaks(recording, channel_ids, thresholds, detect_sign, n_pad, upsample, min_diff_samples,
+                            chunk_size, start_frame=0, end_frame=None, interpolation='parabolic', neighbors=None):
+    # peak times of each channel in [start_frame, end_frame), detected chunk by chunk, by channel or, if the
+    # neighbor table is given, with the locally exclusive method. Chunks are read with margins so that the detection
+    # does not depend on the chunk edges: by channel, a spike belongs to the chunk of its last threshold crossing,
+    # and chunks have n_pad frames on the left for the alignment window, and enough frames on the right to check the
+    # next crossing and for the alignment window. Locally exclusive peaks belong to the chunk of their peak, and
+    # chunks have enough frames on both sides for the exclusion and interpolation windows
+    num_frames = recording.get_num_frames()
+    if end_frame is None:
+        end_frame = num_frames
+    if chunk_size is None:
+        chunk_size = max(end_frame - start_frame, 1)
+    if neighbors is None:
+        margin_left = n_pad
+        margin_right = max(n_pad, min_diff_samples)
+    else:
+        margin_left = margin_right = max(min_diff_samples, _sinc_half_width)
+    thresholds = np.asarray(thresholds, dtype='float64')
+    sp_times = [[np.zeros(0, dtype='int64')] for _ in channel_ids]
+    for start in range(start_frame, end_frame, chunk_size):
+        end = min(start + chunk_size, end_frame)
+        traces = _read_traces(recording, channel_ids, start - margin_left, end + margin_right, num_frames)
+        # buffer positions of the chunk and of the end of the recording
+        i1 = margin_left
+        i2 = i1 + end - start
+        i_valid = min(traces.shape[1], num_frames - start + margin_left)
+        if neighbors is None:
+            channels, peaks = _detect_and_align_peaks_chunk(traces, thresholds, detect_sign, n_pad, upsample,
+                                                            min_diff_samples, i1, i2, i_valid, interpolation)
+        else:
+            channels, peaks = _detect_locally_exclusive_peaks_chunk(traces, thresholds, detect_sign, neighbors,
+                                                                    upsample, min_diff_samples, i1, i2,
+                                                                    interpolation)
+        peaks = np.clip(peaks + start - margin_left, 0, num_frames - 1)
+        bounds = np.searchsorted(channels, np.arange(len(channel_ids) + 1))
+        for i in range(len(channel_ids)):
+            sp_times[i].append(peaks[bounds[i]:bounds[i + 1]])
+    return [np.concatenate(t) for t in sp_times]
+
+
+def _detect_and_align_peaks_parallel(recording, channel_ids, thresholds, detect_sign, n_pad, upsample,
+                                     min_diff_samples, chunk_size, n_jobs, interpolation='parabolic', neighbors=None):
+    # the recording is split in contiguous ranges of whole chunks, detected in parallel processes. Each range reads
+    # its margins from the recording and keeps the spikes assigned to its own frames, so that concatenating the
+    # ranges in order gives the same spikes as a sequential detection
+    num_frames = recording.get_num_frames()
+    if chunk_size is None:
+        chunk_size = max(num_frames, 1)
+    num_chunks = -(-num_frames // chunk_size)
+    num_ranges = max(1, min(num_chunks, effective_n_jobs(n_jobs) * _ranges_per_job))
+    bounds = np.unique(np.linspace(0, num_chunks, num_ranges + 1).astype(int)) * chunk_size
+    bounds[-1] = num_frames
+    # arrays larger than max_nbytes (e.g. in-memory traces) are passed to the workers as memory maps
+    output = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+        delayed(_detect_and_align_peaks)(recording, channel_ids, thresholds, detect_sign, n_pad, upsample,
+                                         min_diff_samples, chunk_size, start_frame=int(start), end_frame=int(end),
+                                         interpolation=interpolation, neighbors=neighbors)
+        for start, end in zip(bounds[:-1], bounds[1:]))
+    return [np.concatenate([o[i] for o in output]) for i in range(len(channel_ids))]
+
+
+def _detect_and_align_peaks_chunk(traces, thresholds, detect_sign, n_pad, upsample, min_diff_samples, i1, i2,
+                                  i_valid, interpolation='parabolic'):
+    # threshold crossings in [i1, i_valid), and the last crossing of each group of crossings less than
+    # min_diff_samples apart, if it is in [i1, i2). Returns the channel (row) and the aligned peak time (in the
+    # buffer) of each spike, sorted by channel and time
+    traces_valid = traces[:, i1:i_valid]
+    thresholds = thresholds[:, np.newaxis]
     if detect_sign == -1:
-        thresh = -n_std * np.median(np.abs(trace) / 0.6745)
-        idx_spikes = np.where(trace < thresh)[0]
+        crossings = traces_valid < -thresholds
     elif detect_sign == 1:
-        thresh = n_std * np.median(np.abs(trace) / 0.6745)
-        idx_spikes = np.where(trace > thresh)[0]
+        crossings = traces_valid > thresholds
+    else:
+        crossings = (traces_valid > thresholds) | (traces_valid < -thresholds)
+    channels, idx_spikes = np.nonzero(crossings)
+    idx_spikes += i1
+    is_last = np.ones(len(idx_spikes), dtype=bool)
+    is_last[:-1] = (np.diff(idx_spikes) > min_diff_samples) | (np.diff(channels) != 0)
+    keep = is_last & (idx_spikes < i2)
+    channels = channels[keep]
+    idx_spikes = idx_spikes[keep]
+
+    # alignment windows of all spikes
+    windows = traces[channels[:, np.newaxis], idx_spikes[:, np.newaxis] + np.arange(-n_pad, n_pad)]
+    if upsample > 1 and interpolation == 'fft':
+        # upsample and find minimum
+        if len(windows) > 0:
+            windows = ss.resample(windows, int(upsample * 2 * n_pad), axis=1)
+        peak_idx = _get_extremum(windows, detect_sign)
+        # time of the upsampled sample, in a window spanning the original samples
+        step = (2 * n_pad - 1) / (windows.shape[1] - 1)
+        peaks = np.floor(idx_spikes - n_pad + peak_idx * step).astype('int64')
+    else:
+        peak_idx = _get_extremum(windows, detect_sign)
+        peaks = idx_spikes - n_pad + peak_idx
+        if upsample > 1 and len(windows) > 0:
+            offsets = _interpolate_extremum(windows, peak_idx, detect_sign, upsample, interpolation)
+            peaks = np.floor(peaks + offsets)
+        peaks = peaks.astype('int64')
+    return channels, peaks
+
+
+def _detect_locally_exclusive_peaks_chunk(traces, thresholds, detect_sign, neighbors, upsample, min_diff_samples,
+                                          i1, i2, interpolation='parabolic'):
+    # peaks in [i1, i2) above threshold and larger than all the values of the neighbor channels within
+    # min_diff_samples frames (strictly larger than the earlier ones, so that equal values give a single peak).
+    # Returns the channel (row) and the peak time (in the buffer) of each spike, sorted by channel and time
+    if detect_sign == -1:
+        z = -traces.astype('float64')
+    elif detect_sign == 1:
+        z = traces.astype('float64')
+    else:
+        z = np.abs(traces.astype('float64'))
+    num_channels, num_samples = z.shape
+    w = min_diff_samples
+    # maxima of each channel over [t - w, t - 1] and [t, t + w], for t in [i1, i2), as running maxima of shifted
+    # slices (the buffer has at least w frames on each side of the chunk)
+    left = np.full((num_channels, i2 - i1), -np.inf)
+    right = z[:, i1:i2].copy()
+    for k in range(1, w + 1):
+        np.maximum(left, z[:, i1 - k:i2 - k], out=left)
+        np.maximum(right, z[:, i1 + k:i2 + k], out=right)
+    # maxima over the neighbors, with a row of -inf for the padding of the neighbor table
+    left = np.vstack([left, np.full((1, i2 - i1), -np.inf)])
+    right = np.vstack([right, np.full((1, i2 - i1), -np.inf)])
+    left_neighbors = left[neighbors[:, 0]]
+    right_neighbors = right[neighbors[:, 0]]
+    for k in range(1, neighbors.shape[1]):
+        np.maximum(left_neighbors, left[neighbors[:, k]], out=left_neighbors)
+        np.maximum(right_neighbors, right[neighbors[:, k]], out=right_neighbors)
+    z_chunk = z[:, i1:i2]
+    is_peak = (z_chunk > thresholds[:, np.newaxis]) & (z_chunk > left_neighbors) & (z_chunk >= right_neighbors)
+    channels, peaks = np.nonzero(is_peak)
+    peaks += i1
+    # equal values on neighbor channels at the same time: the first channel is kept
+    order = np.lexsort((channels, peaks))
+    is_neighbor = np.zeros((num_channels, num_channels + 1), dtype=bool)
+    is_neighbor[np.arange(num_channels)[:, np.newaxis], neighbors] = True
+    duplicate = (np.diff(peaks[order]) == 0) & is_neighbor[channels[order][:-1], channels[order][1:]]
+    keep = np.ones(len(peaks), dtype=bool)
+    keep[order[1:][duplicate]] = False
+    channels = channels[keep]
+    peaks = peaks[keep]
+
+    if upsample > 1 and len(peaks) > 0:
+        half_width = _sinc_half_width
+        windows = traces[channels[:, np.newaxis], peaks[:, np.newaxis] + np.arange(-half_width, half_width + 1)]
+        offsets = _interpolate_extremum(windows, np.full(len(peaks), half_width), detect_sign, upsample,
+                                        interpolation)
+        peaks = np.floor(peaks + offsets)
+    return channels, peaks.astype('int64')
+
+
+def _get_extremum(windows, detect_sign):
+    if detect_sign == -1:
+        return np.argmin(windows, axis=1)
+    elif detect_sign == 1:
+        return np.argmax(windows, axis=1)
+    else:
+        return np.argmax(np.abs(windows), axis=1)
+
+
+def _interpolate_extremum(windows, peak_idx, detect_sign, upsample, interpolation):
+    # sub-sample offset of the extremum of each window (at peak_idx), on a grid of 1 / upsample samples
+    half_width = 1 if interpolation == 'parabolic' else _sinc_half_width
+    padded = np.pad(windows, ((0, 0), (half_width, half_width)), mode='edge')
+    local = padded[np.arange(len(windows))[:, np.newaxis], peak_idx[:, np.newaxis] + np.arange(2 * half_width + 1)]
+    if interpolation == 'parabolic':
+        y0, y1, y2 = local.T.astype('float64')
+        den = y0 - 2 * y1 + y2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offsets = np.where(den != 0, 0.5 * (y0 - y2) / den, 0.)
+        offsets = np.clip(offsets, -0.5, 0.5)
+        return np.round(offsets * upsample) / upsample
     else:
-        thresh = n_std * np.median(np.abs(trace) / 0.6745)
-        idx_spikes = np.where((trace > thresh) | (trace < -thresh))[0]
-    intervals = np.diff(idx_spikes)
-    sp_times = []
-
-    for i_t, diff in enumerate(intervals):
-        if diff > min_diff_samples or i_t == len(intervals) - 1:
-            idx_spike = idx_spikes[i_t]
-            if idx_spike - n_pad > 0 and idx_spike + n_pad < len(trace):
-                spike = trace[idx_spike - n_pad:idx_spike + n_pad]
-                t_spike = np.arange(idx_spike - n_pad, idx_spike + n_pad)
-            elif idx_spike - n_pad < 0:
-                spike = trace[:idx_spike + n_pad]
-                spike = np.pad(spike, (np.abs(idx_spike - n_pad), 0), 'constant')
-                t_spike = np.arange(idx_spike + n_pad)
-                t_spike = np.pad(t_spike, (np.abs(idx_spike - n_pad), 0), 'constant')
-            elif idx_spike + n_pad > len(trace):
-                spike = trace[idx_spike - n_pad:]
-                spike = np.pad(spike, (0, idx_spike + n_pad - len(trace)), 'constant')
-                t_spike = np.arange(idx_spike - n_pad, len(trace))
-                t_spike = np.pad(t_spike, (0, idx_spike + n_pad - len(trace)), 'constant')
-
-            # upsample and find minimum
-            if upsample > 1:
-                spike_up = ss.resample(spike, int(upsample * len(spike)))
-                t_spike_up = np.linspace(t_spike[0], t_spike[-1], num=len(spike_up))
-            else:
-                spike_up = spike
-                t_spike_up = t_spike
-
-            if detect_sign == -1:
-                peak_idx = np.argmin(spike_up)
-            elif detect_sign == 1:
-                peak_idx = np.argmax(spike_up)
-            else:
-                peak_idx = np.argmax(np.abs(spike_up))
-
-            min_time_up = t_spike_up[peak_idx]
-            sp_times.append(int(min_time_up))
-
-    labels = [channel] * len(sp_times)
-
-    return sp_times, labels
+        # interpolated values at the grid offsets within one sample of the extremum
+        grid = np.arange(-upsample + 1, upsample) / upsample
+        x = grid[:, np.newaxis] - np.arange(-half_width, half_width + 1)
+        kernel = np.where(np.abs(x) < half_width, np.sinc(x) * np.sinc(x / half_width), 0.)
+        values = local @ kernel.T
+        return grid[_get_extremum(values, detect_sign)]
@@ -1,10 +1,24 @@
 import numpy as np
+import scipy.signal as ss
 import spikeextractors as se
 import pytest
-from spiketoolkit.tests.utils import check_signal_power_signal1_below_signal2
+import gc
+import weakref
+from pathlib import Path
+from spiketoolkit.tests.utils import check_signal_power_signal1_below_signal2, count_get_traces_calls
 from spiketoolkit.preprocessing import bandpass_filter, blank_saturation, clip_traces, common_reference, \
     normalize_by_quantile, notch_filter, rectify, remove_artifacts, remove_bad_channels, resample, transform_traces, \
-    whiten
+    whiten, pipeline, read_ahead, CommonReferenceRecording, FilteredChunkCache, get_global_chunk_cache, \
+    get_recording_fingerprint, get_cache_folder, set_cache_folder, get_recording_statistics
+
+
+@pytest.fixture
+def cache_folder(tmp_path):
+    # the preprocessing cache folder is set to a temporary folder and restored after the test
+    previous_cache_folder = get_cache_folder()
+    set_cache_folder(tmp_path)
+    yield tmp_path
+    set_cache_folder(previous_cache_folder)
 
 
 @pytest.mark.implemented
@@ -18,6 +32,11 @@ def test_bandpass_filter():
     assert check_signal_power_signal1_below_signal2(rec_fft.get_traces(), rec.get_traces(), freq_range=[10000, 15000],
                                                     fs=rec.get_sampling_frequency())
 
+    rec_fft32 = bandpass_filter(rec, freq_min=5000, freq_max=10000, type='fft', compute_dtype='float32', workers=2)
+    traces_fft = rec_fft.get_traces()
+    assert np.allclose(rec_fft32.get_traces(), traces_fft, atol=1e-3 * np.max(np.abs(traces_fft)))
+    assert len(rec_fft32._kernels) == 1
+
     rec_sci = bandpass_filter(rec, freq_min=3000, freq_max=6000, type='butter', order=3)
 
     assert check_signal_power_signal1_below_signal2(rec_sci.get_traces(), rec.get_traces(), freq_range=[1000, 3000],
@@ -25,6 +44,15 @@ def test_bandpass_filter():
     assert check_signal_power_signal1_below_signal2(rec_sci.get_traces(), rec.get_traces(), freq_range=[6000, 10000],
                                                     fs=rec.get_sampling_frequency())
 
+    rec_sci32 = bandpass_filter(rec, freq_min=3000, freq_max=6000, type='butter', order=3, compute_dtype='float32')
+    traces_sci = rec_sci.get_traces()
+    assert np.allclose(rec_sci32.get_traces(), traces_sci, atol=1e-3 * np.max(np.abs(traces_sci)))
+    assert rec_sci._padding < 3000
+
+    # high orders are stable with second-order sections
+    rec_sci8 = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', order=8)
+    assert np.all(np.isfinite(rec_sci8.get_traces(end_frame=60000)))
+
     rec_cache = bandpass_filter(rec, freq_min=3000, freq_max=6000, type='butter', order=3, cache_to_file=True)
 
     assert check_signal_power_signal1_below_signal2(rec_cache.get_traces(), rec.get_traces(), freq_range=[1000, 3000],
@@ -42,19 +70,127 @@ def test_bandpass_filter_with_cache():
     
     rec_filtered3 = bandpass_filter(rec, freq_min=5000, freq_max=10000, cache_chunks=True, chunk_size=10000)
     rec_filtered3.get_traces()
-    assert rec_filtered3._filtered_cache_chunks.get('0') is not None
+    assert rec_filtered3._get_cached_chunk(0) is not None
     
     rec_filtered4 = bandpass_filter(rec, freq_min=5000, freq_max=10000, cache_chunks=True, chunk_size=None)
     
     assert np.allclose(rec_filtered.get_traces(), rec_filtered2.get_traces(), rtol=1e-02, atol=1e-02)
     assert np.allclose(rec_filtered.get_traces(), rec_filtered3.get_traces(), rtol=1e-02, atol=1e-02)
     assert np.allclose(rec_filtered.get_traces(), rec_filtered4.get_traces(), rtol=1e-02, atol=1e-02)
+
+    # kernels of many window lengths are not all kept
+    rec_fft = bandpass_filter(rec, freq_min=300, freq_max=6000, type='fft', chunk_size=None)
+    for length in range(100, 1100, 100):
+        rec_fft.get_traces(start_frame=0, end_frame=length)
+    assert len(rec_fft._kernels) <= 4
+
+
+@pytest.mark.implemented
+def test_filter_parallel_chunks():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000)
+    rec_thread = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000, n_jobs=2)
+    rec_process = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000, n_jobs=2, backend='process',
+                                  cache_chunks=True)
+
+    assert np.array_equal(rec_f.get_traces(), rec_thread.get_traces())
+    assert np.array_equal(rec_f.get_traces(), rec_process.get_traces())
+    assert np.array_equal(rec_f.get_traces(channel_ids=[1, 3], start_frame=5000, end_frame=45000),
+                          rec_thread.get_traces(channel_ids=[1, 3], start_frame=5000, end_frame=45000))
+    assert rec_process._get_cached_chunk(0) is not None
     
     
     
 
 
 
+@pytest.mark.implemented
+def test_filter_channel_subset():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    for rec_f in [bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000),
+                  bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000, cache_chunks=True),
+                  bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=None),
+                  notch_filter(rec, 3000, q=10, chunk_size=10000),
+                  whiten(rec, chunk_size=10000)]:
+        traces = rec_f.get_traces(start_frame=5000, end_frame=25000)
+        for channel_ids in [[2], [3, 1], 0]:
+            traces_sub = rec_f.get_traces(channel_ids=channel_ids, start_frame=5000, end_frame=25000)
+            assert np.allclose(traces_sub, traces[np.atleast_1d(channel_ids)])
+
+
+@pytest.mark.implemented
+def test_filtered_chunk_cache():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    chunk_bytes = 4 * 10000 * 8
+    cache = FilteredChunkCache(max_memory=3 * chunk_bytes)
+    rec_bp = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000, cache_chunks=cache)
+    rec_notch = notch_filter(rec_bp, 3000, q=10, chunk_size=10000, cache_chunks=cache)
+
+    rec_bp.get_traces(start_frame=0, end_frame=20000)
+    assert cache.get_stats()['misses'] == 2
+    rec_bp.get_traces(start_frame=0, end_frame=20000)
+    assert cache.get_stats()['hits'] == 2
+    assert cache.get_memory() == 2 * chunk_bytes
+
+    # the chunks of both extractors share the same budget
+    rec_notch.get_traces(start_frame=0, end_frame=30000)
+    assert cache.get_memory() == 3 * chunk_bytes
+    assert cache.get_stats()['evictions'] > 0
+
+    # least recently used chunks are evicted first
+    cache = FilteredChunkCache(max_memory=2 * chunk_bytes)
+    chunk = np.zeros((4, 10000))
+    cache.add('a', chunk)
+    cache.add('b', chunk)
+    cache.get('a')
+    cache.add('c', chunk)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+    rec_global = bandpass_filter(rec, cache_chunks='global')
+    assert rec_global._filtered_cache_chunks is get_global_chunk_cache()
+
+
+@pytest.mark.implemented
+def test_filtered_chunk_cache_disk():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    chunk_bytes = 4 * 10000 * 8
+    cache = FilteredChunkCache(max_memory=2 * chunk_bytes, max_disk=10 * chunk_bytes)
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000, cache_chunks=cache)
+    rec_ref = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000)
+
+    traces = rec_f.get_traces()
+    assert cache.get_stats()['num_disk_chunks'] == 10
+    # the last 12 chunks are either in memory or on disk
+    assert np.array_equal(rec_f.get_traces(start_frame=180000), traces[:, 180000:])
+    assert cache.get_stats()['disk_hits'] == 10
+    assert np.array_equal(traces, rec_ref.get_traces())
+
+    # disk hits are copies, which stay valid when their slot is recycled
+    chunk0 = cache.get(next(iter(cache._disk_chunks._slots_by_code)))
+    assert chunk0.flags.writeable
+    saved = chunk0.copy()
+    for ich in range(10, 20):
+        cache._spill(('other', ich), np.zeros((4, 10000)))
+    assert np.array_equal(chunk0, saved)
+
+    # slots sized for the widest extractor sharing the cache
+    cache_wide = FilteredChunkCache(max_memory=0, max_disk=10 * chunk_bytes, disk_slot_nbytes=2 * chunk_bytes)
+    cache_wide.add('narrow', np.ones((4, 10000)))
+    cache_wide.add('wide', np.ones((8, 10000)))
+    assert cache_wide.get_stats()['num_disk_chunks'] == 2
+
+    tmp_file = cache._disk_chunks.get_filename()
+    assert Path(tmp_file).is_file()
+    del rec_f, cache
+    gc.collect()
+    assert not Path(tmp_file).is_file()
+
+
 @pytest.mark.implemented
 def test_blank_saturation():
     rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
@@ -115,6 +251,48 @@ def test_common_reference():
     assert np.allclose(rec_sin_g.get_traces()[3], traces[3] - traces[2])
     assert 'int16' in str(rec_cmr_int16_g.get_dtype())
 
+    # channels subsets and groups in any order, with a single read of the parent per call
+    groups = [[3, 1], [2, 0]]
+    rec_cmr_g = common_reference(rec, reference='median', groups=groups, n_jobs=2)
+    rec_sin_g = common_reference(rec, reference='single', ref_channels=[1, 0], groups=groups)
+    traces_cmr = rec_cmr_g.get_traces()
+    for g in groups:
+        assert np.allclose(traces_cmr[g], traces[g] - np.median(traces[g], axis=0, keepdims=True))
+    assert np.allclose(rec_sin_g.get_traces(channel_ids=[3, 2]), traces[[3, 2]] - traces[[1, 0]])
+    assert np.array_equal(common_reference(rec, reference='median', groups=groups).get_traces(), traces_cmr)
+
+    num_reads = count_get_traces_calls(rec)
+    traces_sub = rec_cmr_g.get_traces(channel_ids=[2, 3], start_frame=100, end_frame=200)
+    assert len(num_reads) == 1
+    assert np.allclose(traces_sub, traces_cmr[[2, 3], 100:200])
+
+
+@pytest.mark.implemented
+def test_local_common_reference():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=6)
+    traces = rec.get_traces()
+
+    # channels are on a line with 1 um pitch: the annulus (1, 2) contains up to 2 channels on each side
+    rec_local = common_reference(rec, reference='local', local_radius=(1, 2))
+    neighbors = [[1, 2], [0, 2, 3], [0, 1, 3, 4], [1, 2, 4, 5], [2, 3, 5], [3, 4]]
+    traces_expected = np.array([traces[ch] - np.median(traces[n], axis=0) for ch, n in enumerate(neighbors)])
+    assert np.allclose(rec_local.get_traces(), traces_expected)
+    assert np.allclose(rec_local.get_traces(channel_ids=[4, 0], start_frame=100, end_frame=300),
+                       traces_expected[[4, 0], 100:300])
+    rec_pipe = pipeline(rec, [('CommonReference', {'reference': 'local', 'local_radius': (1, 2)})])
+    assert np.allclose(rec_pipe.get_traces(start_frame=0, end_frame=30000), traces_expected[:, :30000])
+
+    # neighbors are taken within the same group, channels without neighbors are not referenced
+    rec_local_g = common_reference(rec, reference='local', local_radius=(1, 2), groups=[[0, 1, 2], [3, 4]])
+    traces_g = rec_local_g.get_traces()
+    assert np.allclose(traces_g[0], traces[0] - np.median(traces[[1, 2]], axis=0))
+    assert np.allclose(traces_g[3], traces[3] - traces[4])
+    assert np.allclose(traces_g[5], traces[5])
+
+    rec_no_loc = se.NumpyRecordingExtractor(timeseries=traces, sampling_frequency=rec.get_sampling_frequency())
+    with pytest.raises(ValueError):
+        common_reference(rec_no_loc, reference='local')
+
 
 @pytest.mark.notimplemented
 def test_norm_by_quantile():
@@ -130,6 +308,64 @@ def test_notch_filter():
     assert check_signal_power_signal1_below_signal2(rec_n.get_traces(), rec.get_traces(), freq_range=[2900, 3100],
                                                     fs=rec.get_sampling_frequency())
 
+    rec_n32 = notch_filter(rec, 3000, q=10, compute_dtype='float32')
+    traces_n = rec_n.get_traces()
+    assert np.allclose(rec_n32.get_traces(), traces_n, atol=1e-3 * np.max(np.abs(traces_n)))
+
+    # padding follows the decay of the impulse response: narrower notches need longer padding
+    assert notch_filter(rec, 3000, q=30)._padding > rec_n._padding
+    # the padding can be traded against accuracy
+    rec_tol = notch_filter(rec, 3000, q=30, padding_tol=1e-4)
+    assert rec_tol._padding < notch_filter(rec, 3000, q=30)._padding
+    assert notch_filter(rec, 3000, q=30, padding=500)._padding == 500
+    # the derived padding of long ringing notches is capped
+    assert notch_filter(rec, 50, q=30)._padding == 3000
+    assert notch_filter(rec, 50, q=30, padding=20000)._padding == 20000
+    assert bandpass_filter(rec, type='butter', padding=1000)._padding == 1000
+
+    # several notches are applied as a single cascade, equivalent to chaining the notch filters
+    rec_h = notch_filter(rec, 3000, q=10, harmonics=3)
+    assert np.allclose(rec_h._freqs, [3000, 6000, 9000])
+    assert rec_h._sos.shape[0] == 3 * rec_n._sos.shape[0]
+    rec_chained = notch_filter(notch_filter(rec_n, 6000, q=10), 9000, q=10)
+    traces_chained = rec_chained.get_traces()
+    traces_h = rec_h.get_traces()
+    assert np.allclose(notch_filter(rec, [3000, 6000, 9000], q=10).get_traces(), traces_h)
+    # sosfiltfilt pads the edges of the recording differently for the cascade and for each filter
+    assert np.allclose(traces_h[:, 1000:-1000], traces_chained[:, 1000:-1000],
+                       atol=1e-3 * np.max(np.abs(traces_chained)))
+    for freq in [3000, 6000, 9000]:
+        assert check_signal_power_signal1_below_signal2(traces_h, rec.get_traces(), freq_range=[freq - 100, freq + 100],
+                                                        fs=rec.get_sampling_frequency())
+    with pytest.raises(ValueError):
+        notch_filter(rec, 3000, harmonics=5)
+
+
+@pytest.mark.implemented
+def test_causal_filter():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    traces = rec.get_traces()
+    fs = rec.get_sampling_frequency()
+
+    sos = ss.butter(3, np.array([300, 6000]) / fs * 2, btype='bandpass', output='sos')
+    zi = ss.sosfilt_zi(sos)[:, np.newaxis, :] * traces[np.newaxis, :, :1]
+    traces_causal, _ = ss.sosfilt(sos, traces, axis=1, zi=zi)
+
+    rec_c = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', causal=True, chunk_size=10000)
+    # random access first, then sequential reads reusing the carried state
+    assert np.allclose(rec_c.get_traces(start_frame=150000, end_frame=160000), traces_causal[:, 150000:160000])
+    assert np.allclose(rec_c.get_traces(channel_ids=[1, 3]), traces_causal[[1, 3]])
+
+    blocks = list(rec_c.stream(block_size=7000))
+    assert [pos for pos, _ in blocks] == list(range(0, rec.get_num_frames(), 7000))
+    assert np.allclose(np.concatenate([block for _, block in blocks], axis=1), traces_causal)
+
+    rec_nc = notch_filter(rec, 3000, q=10, causal=True)
+    assert check_signal_power_signal1_below_signal2(rec_nc.get_traces(), traces, freq_range=[2900, 3100], fs=fs)
+
+    with pytest.raises(ValueError):
+        bandpass_filter(rec, type='fft', causal=True)
+
 
 @pytest.mark.implemented
 def test_rectify():
@@ -140,6 +376,100 @@ def test_rectify():
     assert np.allclose(rec_rect.get_traces(), np.abs(rec.get_traces()))
 
 
+@pytest.mark.implemented
+def test_read_ahead():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000)
+    rec_ra = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000, read_ahead=True)
+    traces_f = rec_f.get_traces()
+    assert np.allclose(rec_ra.get_traces(), traces_f)
+    # the chunk after the last one read is being filtered in the background
+    assert rec_ra._read_ahead_job is None
+    rec_ra.get_traces(start_frame=0, end_frame=15000)
+    assert rec_ra._read_ahead_job[0] == (2, None)
+    assert np.allclose(rec_ra.get_traces(start_frame=15000, end_frame=25000), traces_f[:, 15000:25000])
+    assert np.allclose(rec_ra.get_traces(channel_ids=[1], start_frame=25000, end_frame=45000),
+                       traces_f[[1], 25000:45000])
+
+    rec_wa = read_ahead(rec_f)
+    chunks = [rec_wa.get_traces(start_frame=start, end_frame=min(start + 70000, rec.get_num_frames()))
+              for start in range(0, rec.get_num_frames(), 70000)]
+    assert np.allclose(np.concatenate(chunks, axis=1), traces_f)
+    assert rec_wa._job is None
+    assert np.allclose(rec_wa.get_traces(channel_ids=[0, 2], start_frame=1000, end_frame=2000),
+                       traces_f[[0, 2], 1000:2000])
+
+
+@pytest.mark.implemented
+def test_elementwise_chain():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    traces = rec.get_traces()
+
+    rec_chain = rectify(clip_traces(transform_traces(rec, scalar=2, offset=1), a_min=-30, a_max=20))
+    assert rec_chain._source is rec
+    assert len(rec_chain._operations) == 3
+    assert np.allclose(rec_chain.get_traces(), np.abs(np.clip(2 * traces + 1, -30, 20)))
+    assert np.allclose(rec_chain.get_traces(channel_ids=[2], start_frame=10, end_frame=20),
+                       np.abs(np.clip(2 * traces[[2], 10:20] + 1, -30, 20)))
+
+    # the source is read once for the whole chain, and its traces are not modified
+    num_reads = count_get_traces_calls(rec)
+    rec_chain.get_traces(start_frame=0, end_frame=1000)
+    assert len(num_reads) == 1
+    assert np.array_equal(rec.get_traces(), traces)
+
+    # the chain is computed in the output dtype of its operations
+    rec_int = se.NumpyRecordingExtractor(timeseries=(traces * 100).astype('int16'),
+                                         sampling_frequency=rec.get_sampling_frequency())
+    assert rectify(clip_traces(rec_int, a_max=100)).get_traces().dtype == np.dtype('int16')
+    traces_c = clip_traces(rec_int, a_min=np.float64(-3.0), a_max=100.5).get_traces()
+    assert traces_c.dtype == np.dtype('int16')
+    assert np.array_equal(traces_c, np.clip((traces * 100).astype('int16'), -3, 100))
+    traces_t = rectify(transform_traces(rec_int, scalar=0.5)).get_traces()
+    assert traces_t.dtype == np.dtype('float64')
+    assert np.allclose(traces_t, np.abs(0.5 * (traces * 100).astype('int16')))
+
+
+@pytest.mark.implemented
+def test_pipeline():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    rec_nested = clip_traces(common_reference(bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=10000),
+                                              reference='median'), a_min=-20, a_max=20)
+    rec_pipe = pipeline(rec, [('BandpassFilter', dict(freq_min=300, freq_max=6000)),
+                              (CommonReferenceRecording, dict(reference='median')),
+                              ('ClipTraces', dict(a_min=-20, a_max=20))], chunk_size=10000)
+
+    assert len(rec_pipe.get_fused_stages()) == 3
+    assert rec_pipe.get_margin() == 3000
+    assert np.allclose(rec_pipe.get_traces(), rec_nested.get_traces())
+    assert np.allclose(rec_pipe.get_traces(channel_ids=[1], start_frame=5000, end_frame=15000),
+                       rec_nested.get_traces(channel_ids=[1], start_frame=5000, end_frame=15000))
+
+    # the fused whitening and stacked filters match the nested chain, also at the end of the recording
+    rec_nested_w = whiten(bandpass_filter(rec, chunk_size=10000), chunk_size=10000, cache_matrix=False)
+    rec_pipe_w = pipeline(rec, [('BandpassFilter', None), ('Whiten', dict(cache_matrix=False))], chunk_size=10000)
+    assert np.allclose(rec_pipe_w.get_traces(), rec_nested_w.get_traces(), atol=1e-4)
+    rec_nested_bb = bandpass_filter(bandpass_filter(rec, type='butter', chunk_size=10000), type='butter',
+                                    chunk_size=10000)
+    rec_pipe_bb = pipeline(rec, [('BandpassFilter', dict(type='butter')), ('BandpassFilter', dict(type='butter'))],
+                           chunk_size=10000)
+    traces_nested_bb = rec_nested_bb.get_traces()
+    assert np.allclose(rec_pipe_bb.get_traces(), traces_nested_bb, atol=1e-4 * np.max(np.abs(traces_nested_bb)))
+
+    # stages after a non-fusable one are fused on top of it
+    rec_pipe_rm = pipeline(rec, [('RemoveBadChannels', dict(bad_channel_ids=[0], bad_threshold=2, seconds=1,
+                                                            verbose=False)),
+                                 ('Rectify', None)], chunk_size=10000)
+    assert rec_pipe_rm.get_fused_stages() == rec_pipe_rm.get_stages()[1:]
+    assert rec_pipe_rm.get_channel_ids() == [1, 2, 3]
+    assert np.allclose(rec_pipe_rm.get_traces(), np.abs(rec.get_traces(channel_ids=[1, 2, 3])))
+
+    with pytest.raises(ValueError):
+        pipeline(rec, [('NotAPreprocessor', {})])
+
+
 @pytest.mark.implemented
 def test_remove_artifacts():
     rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
@@ -158,6 +488,19 @@ def test_remove_artifacts():
     assert not np.any(traces_short_0)
     assert not np.any(traces_short_1)
 
+    # unsorted and overlapping triggers: windows are blanked like the full recording
+    triggers = [150000, 3000, 90000, 90100, 60000, 299990]
+    rec_rmart = remove_artifacts(rec, triggers, ms_before=1, ms_after=5)
+    assert len(rec_rmart._interval_starts) == 5
+    traces = rec.get_traces()
+    traces_expected = traces.copy()
+    for trig in triggers:
+        traces_expected[:, max(trig - 30, 0):trig + 150] = 0
+    assert np.array_equal(rec_rmart.get_traces(), traces_expected)
+    for start, end in [(2900, 3000), (3100, 3200), (90000, 90200), (149900, 150100), (299980, 300000)]:
+        assert np.array_equal(rec_rmart.get_traces(start_frame=start, end_frame=end, channel_ids=[1, 2]),
+                              traces_expected[[1, 2], start:end])
+
 
 @pytest.mark.implemented
 def test_remove_bad_channels():
@@ -182,6 +525,28 @@ def test_remove_bad_channels():
     assert 1 not in rec_rm.get_channel_ids()
 
 
+@pytest.mark.implemented
+def test_remove_bad_channels_methods(cache_folder):
+    timeseries = np.random.RandomState(0).randn(6, 300000)
+    timeseries += 2 * np.random.RandomState(1).randn(300000)
+    timeseries[1] *= 4
+    timeseries[4] = np.random.RandomState(2).randn(300000)
+    rec_np = se.NumpyRecordingExtractor(timeseries=timeseries, sampling_frequency=30000)
+
+    for method, bad_channel in [('std', 1), ('mad', 1), ('coherence', 4)]:
+        rec_rm = remove_bad_channels(rec_np, bad_channel_ids=None, bad_threshold=1.5, seconds=2, method=method,
+                                     n_jobs=2)
+        assert rec_rm.get_channel_ids() == [ch for ch in range(6) if ch != bad_channel]
+
+    # the detected channels are cached
+    remove_bad_channels(rec_np, bad_channel_ids=None, bad_threshold=1.5, seconds=2, cache_mask=True)
+    assert len(list(cache_folder.iterdir())) == 1
+    num_reads = count_get_traces_calls(rec_np)
+    rec_rm = remove_bad_channels(rec_np, bad_channel_ids=None, bad_threshold=1.5, seconds=2, cache_mask=True)
+    assert len(num_reads) == 0
+    assert 1 not in rec_rm.get_channel_ids()
+
+
 @pytest.mark.implemented
 def test_resample():
     rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
@@ -195,6 +560,23 @@ def test_resample():
     assert rec_rsl.get_num_frames() == int(rec.get_num_frames() * 0.1)
     assert rec_rsh.get_num_frames() == int(rec.get_num_frames() * 2)
 
+    # any window is identical to the resampled full recording
+    traces = rec.get_traces()
+    for rec_rs, up, down in [(rec_rsl, 1, 10), (rec_rsh, 2, 1), (resample(rec, 44100, chunk_size=7000), 147, 100)]:
+        traces_rs = ss.resample_poly(traces, up, down, axis=1)[:, :rec_rs.get_num_frames()]
+        assert np.allclose(rec_rs.get_traces(), traces_rs)
+        assert np.allclose(rec_rs.get_traces(channel_ids=[1, 2], start_frame=1001, end_frame=25003),
+                           traces_rs[[1, 2], 1001:25003])
+        assert np.allclose(np.concatenate([rec_rs.get_traces(start_frame=i, end_frame=i + 333) for i in [0, 333, 666]],
+                                          axis=1), traces_rs[:, :999])
+    assert rec_rsl.get_sampling_frequency() == resample_rate_low
+
+    # the exact ratio is used when its factors are small enough, otherwise the approximation is reported
+    assert resample(rec, 12345).get_sampling_frequency() == 12345
+    with pytest.warns(UserWarning):
+        rec_approx = resample(rec, 7000.5)
+    assert rec_approx.get_sampling_frequency() == rec_approx._up / rec_approx._down * rec.get_sampling_frequency()
+
 
 @pytest.mark.implemented
 def test_transform_traces():
@@ -221,6 +603,137 @@ def test_whiten():
     rec_w2 = whiten(rec, chunk_size=30000)
     
     assert np.array_equal(rec_w.get_traces(), rec_w2.get_traces())
+
+    # the covariance after a common average reference is rank deficient
+    rec_car = common_reference(bandpass_filter(se.example_datasets.toy_example(duration=10, num_channels=4,
+                                                                               seed=1)[0]), reference='average')
+    assert np.all(np.isfinite(whiten(rec_car, cache_matrix=False).get_traces()))
+
+
+@pytest.mark.implemented
+def test_whiten_matrix_estimation(cache_folder):
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    # the streaming covariance equals the covariance of the concatenated random chunks
+    rec_w = whiten(rec, num_chunks=20, chunk_length=1000, seed=1)
+    random_ints = np.random.RandomState(seed=1).randint(0, rec.get_num_frames() - 1000, size=20)
+    data = np.concatenate([rec.get_traces(start_frame=ff, end_frame=ff + 1000) for ff in random_ints], axis=1)
+    assert np.allclose(rec_w._compute_covariance(seed=1), np.cov(data, bias=True))
+    assert np.allclose(rec_w._whitening_matrix @ np.cov(data, bias=True) @ rec_w._whitening_matrix.T, np.eye(4))
+    assert np.all(np.abs(whiten(rec, eps=100)._whitening_matrix) <
+                  np.max(np.abs(rec_w._whitening_matrix)))
+
+    # the matrix is saved once and reused for the same recording and parameters
+    assert len(list(cache_folder.iterdir())) == 0
+    rec_w1 = whiten(rec, num_chunks=20, chunk_length=1000, seed=1, cache_matrix=True)
+    assert len(list(cache_folder.iterdir())) == 1
+    assert np.allclose(rec_w1._whitening_matrix, rec_w._whitening_matrix)
+    num_reads = count_get_traces_calls(rec)
+    rec_w2 = whiten(rec, num_chunks=20, chunk_length=1000, seed=1, cache_matrix=True)
+    assert len(num_reads) == 0
+    assert np.array_equal(rec_w2._whitening_matrix, rec_w1._whitening_matrix)
+    whiten(rec, num_chunks=20, chunk_length=1000, seed=2, cache_matrix=True)
+    assert len(list(cache_folder.iterdir())) == 2
+    assert get_recording_fingerprint(rec) != get_recording_fingerprint(bandpass_filter(rec))
+
+
+@pytest.mark.implemented
+def test_recording_statistics():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    num_reads = count_get_traces_calls(rec)
+
+    # each statistic is computed once for the recording
+    normalize_by_quantile(rec, seed=3)
+    num_reads_first = len(num_reads)
+    normalize_by_quantile(rec, seed=3, scale=2)
+    whiten(rec, seed=3)
+    num_reads_whiten = len(num_reads)
+    whiten(rec, seed=3)
+    assert len(num_reads) == num_reads_whiten == 2 * num_reads_first
+
+    statistics = get_recording_statistics(rec, seed=3)
+    sample = statistics.get_sample()
+    assert sample.shape == (4, 50 * 500)
+    assert np.allclose(statistics.get_std(), np.std(sample, axis=1))
+    assert np.allclose(statistics.get_covariance(), np.cov(sample, bias=True))
+    assert np.allclose(statistics.get_mad(), np.median(np.abs(sample - np.median(sample, axis=1, keepdims=True)),
+                                                       axis=1))
+    assert np.allclose(statistics.get_quantiles([0.1, 0.9]), np.quantile(sample, [0.1, 0.9]))
+
+    # the statistics are not shared between recording extractors, and do not keep them alive
+    rec_f = bandpass_filter(rec, cache_chunks=True)
+    assert get_recording_statistics(rec_f, seed=3) is not statistics
+    rec_ref = weakref.ref(rec_f)
+    whiten(rec_f, seed=3)
+    del rec_f
+    gc.collect()
+    assert rec_ref() is None
+
+
+@pytest.mark.implemented
+def test_whiten_local():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=6)
+
+    # with neighborhoods containing all channels, the local whitening is the global one
+    rec_w = whiten(rec, cache_matrix=False)
+    rec_wl_all = whiten(rec, mode='local', radius=100, cache_matrix=False)
+    assert np.allclose(rec_wl_all._whitening_matrix.toarray(), rec_w._whitening_matrix)
+
+    # channels are on a line with 1 um pitch: neighborhoods have up to 3 channels
+    rec_wl = whiten(rec, mode='local', radius=1, cache_matrix=False)
+    assert rec_wl._whitening_matrix.nnz == 16
+    traces_wl = rec_wl.get_traces()
+    assert np.allclose(rec_wl.get_traces(channel_ids=[4, 1], start_frame=1000, end_frame=50000),
+                       traces_wl[[4, 1], 1000:50000])
+    rec_pipe = pipeline(rec, [('Whiten', dict(mode='local', radius=1, cache_matrix=False))])
+    assert np.allclose(rec_pipe.get_traces(start_frame=0, end_frame=30000), traces_wl[:, :30000])
+
+
+@pytest.mark.implemented
+def test_metadata_cache():
+    class CountingRecording(se.NumpyRecordingExtractor):
+        def __init__(self, timeseries, sampling_frequency):
+            se.NumpyRecordingExtractor.__init__(self, timeseries=timeseries, sampling_frequency=sampling_frequency)
+            self.num_reads = 0
+            self.num_frames_calls = 0
+
+        def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+            self.num_reads += 1
+            return se.NumpyRecordingExtractor.get_traces(self, channel_ids=channel_ids, start_frame=start_frame,
+                                                         end_frame=end_frame)
+
+        def get_num_frames(self):
+            self.num_frames_calls += 1
+            return se.NumpyRecordingExtractor.get_num_frames(self)
+
+    traces = np.random.RandomState(0).randn(4, 30000).astype('float32')
+    rec = CountingRecording(timeseries=traces, sampling_frequency=30000)
+    rec_chain = common_reference(transform_traces(bandpass_filter(rec, freq_min=300, freq_max=6000,
+                                                                  chunk_size=None), scalar=2))
+
+    rec_chain.get_traces(start_frame=0, end_frame=100)
+    num_reads = rec.num_reads
+    num_frames_calls = rec.num_frames_calls
+    for start in range(1000, 20000, 1000):
+        rec_chain.get_traces(channel_ids=[1, 2], start_frame=start, end_frame=start + 50)
+    # no dtype probe and no metadata query through the chain for each read
+    assert rec.num_reads - num_reads == 19
+    assert rec.num_frames_calls == num_frames_calls
+    dtype = rec_chain.get_dtype()
+    num_reads = rec.num_reads
+    assert rec_chain.get_dtype() == dtype == rec_chain.get_traces(start_frame=0, end_frame=10).dtype
+    assert rec.num_reads - num_reads == 1
+    assert rec_chain.get_channel_index() == {0: 0, 1: 1, 2: 2, 3: 3}
+    rec_chain.get_channel_ids().append(4)
+    assert rec_chain.get_channel_ids() == [0, 1, 2, 3]
+
+    # the recording grows: refresh_metadata updates the whole chain
+    assert rec_chain.get_num_frames() == 30000
+    rec._timeseries = np.concatenate([traces, traces], axis=1)
+    assert rec_chain.get_num_frames() == 30000
+    rec_chain.refresh_metadata()
+    assert rec_chain.get_num_frames() == 60000
+    assert rec_chain._recording._recording.get_num_frames() == 60000
     
     
     
@@ -1,6 +1,9 @@
 import spikeextractors as se
 import spiketoolkit as st
 import numpy as np
+import scipy.signal as ss
+from spiketoolkit.sortingcomponents.detection import _detect_and_align_peaks_chunk, _get_extremum, \
+    _interpolate_extremum
 
 
 def test_detection():
@@ -37,5 +40,121 @@ def test_detection():
         assert np.array_equal(sort_d_b.get_unit_spike_train(u), sort_dp_b.get_unit_spike_train(u))
 
 
+def test_detection_chunks():
+    rec, sort = se.example_datasets.toy_example(num_channels=4, duration=20, seed=0)
+
+    for detect_sign in [-1, 1, 0]:
+        sort_d = st.sortingcomponents.detect_spikes(rec, detect_sign=detect_sign, chunk_size=None)
+        # chunk edges must not change the detected spikes
+        sort_dc = st.sortingcomponents.detect_spikes(rec, detect_sign=detect_sign, chunk_size=1237)
+        for u in sort_d.get_unit_ids():
+            assert np.array_equal(sort_d.get_unit_spike_train(u), sort_dc.get_unit_spike_train(u))
+
+    # a single crossing at the end of the recording is detected once
+    traces = np.zeros((1, 10000))
+    traces[0, ::997] = 1
+    traces[0, [3000, 9990]] = -100
+    rec_np = se.NumpyRecordingExtractor(timeseries=traces, sampling_frequency=30000)
+    sort_np = st.sortingcomponents.detect_spikes(rec_np, chunk_size=4000)
+    assert np.array_equal(sort_np.get_unit_spike_train(0), [3000, 9990])
+
+
+def test_detection_alignment():
+    traces = np.random.RandomState(0).randn(3, 5000)
+    thresholds = np.full(3, 2.5)
+    n_pad = 10
+    for interpolation, upsample in [('fft', 1), ('fft', 4), ('parabolic', 4)]:
+        channels, peaks = _detect_and_align_peaks_chunk(traces, thresholds, -1, n_pad, upsample, 5, 100, 4900, 4900,
+                                                        interpolation=interpolation)
+        assert len(peaks) > 0
+        # the batched alignment equals the alignment of each spike
+        crossings = [np.nonzero(trace[100:4900] < -2.5)[0] + 100 for trace in traces]
+        for channel, idx_spikes in enumerate(crossings):
+            is_last = np.append(np.diff(idx_spikes) > 5, True)
+            peaks_ref = []
+            for idx_spike in idx_spikes[is_last]:
+                spike = traces[channel, idx_spike - n_pad:idx_spike + n_pad]
+                t_spike = np.arange(idx_spike - n_pad, idx_spike + n_pad)
+                if upsample > 1 and interpolation == 'fft':
+                    spike_up = ss.resample(spike, upsample * len(spike))
+                    t_spike_up = np.linspace(t_spike[0], t_spike[-1], num=len(spike_up))
+                    peaks_ref.append(int(t_spike_up[np.argmin(spike_up)]))
+                else:
+                    peak_idx = _get_extremum(spike[np.newaxis], -1)
+                    peak = t_spike[peak_idx[0]]
+                    if upsample > 1:
+                        peak += _interpolate_extremum(spike[np.newaxis], peak_idx, -1, upsample, interpolation)[0]
+                    peaks_ref.append(int(np.floor(peak)))
+            assert np.array_equal(peaks[channels == channel], peaks_ref)
+
+
+def test_detection_interpolation():
+    # a negative pulse peaking between frames 999 and 1000, closer to 1000
+    t = np.arange(3000)
+    traces = -100 * np.exp(-(t - 999.7) ** 2 / (2 * 3 ** 2))[np.newaxis] + 1e-3 * (-1) ** t
+    rec = se.NumpyRecordingExtractor(timeseries=traces, sampling_frequency=30000)
+
+    sort = st.sortingcomponents.detect_spikes(rec, n_pad_ms=10)
+    assert np.array_equal(sort.get_unit_spike_train(0), [1000])
+    for interpolation in ['parabolic', 'sinc']:
+        sort = st.sortingcomponents.detect_spikes(rec, n_pad_ms=10, upsample=10, interpolation=interpolation)
+        assert np.array_equal(sort.get_unit_spike_train(0), [999])
+
+    rec, sort = se.example_datasets.toy_example(num_channels=4, duration=20, seed=0)
+    sort_p = st.sortingcomponents.detect_spikes(rec, upsample=4, interpolation='parabolic')
+    sort_s = st.sortingcomponents.detect_spikes(rec, upsample=4, interpolation='sinc')
+    for u in sort_p.get_unit_ids():
+        assert np.max(np.abs(sort_p.get_unit_spike_train(u) - sort_s.get_unit_spike_train(u))) <= 1
+
+
+def test_detection_locally_exclusive():
+    rec, sort = se.example_datasets.toy_example(num_channels=4, duration=20, seed=0)
+
+    sort_l = st.sortingcomponents.detect_spikes(rec, method='locally_exclusive', radius=1000, chunk_size=None)
+    sort_lc = st.sortingcomponents.detect_spikes(rec, method='locally_exclusive', radius=1000, chunk_size=1237)
+    assert 'channel' in sort_l.get_shared_unit_property_names()
+    for u in sort_l.get_unit_ids():
+        assert np.array_equal(sort_l.get_unit_spike_train(u), sort_lc.get_unit_spike_train(u))
+    # all channels are neighbors: spikes are at least min_diff_samples apart
+    times = np.sort(np.concatenate([sort_l.get_unit_spike_train(u) for u in sort_l.get_unit_ids()]))
+    assert np.all(np.diff(times) > 5)
+
+    # a spike on 3 channels is detected once, on its peak channel
+    traces = 1e-3 * (-1) ** np.arange(3000) * np.ones((4, 1))
+    traces[:3, 1000] = [-50, -80, -60]
+    traces[3, 2000] = -50
+    rec_np = se.NumpyRecordingExtractor(timeseries=traces, sampling_frequency=30000)
+    rec_np.set_channel_locations([0, 1, 2, 3], [[0, 0], [0, 20], [0, 40], [0, 60]])
+    sort_np = st.sortingcomponents.detect_spikes(rec_np, method='locally_exclusive', radius=30)
+    assert list(sort_np.get_unit_ids()) == [1, 3]
+    assert np.array_equal(sort_np.get_unit_spike_train(1), [1000])
+    assert np.array_equal(sort_np.get_unit_spike_train(3), [2000])
+
+
+def test_detection_parallel_time():
+    rec, sort = se.example_datasets.toy_example(num_channels=4, duration=20, seed=0)
+    rec_f = st.preprocessing.bandpass_filter(rec, freq_min=300, freq_max=6000)
+
+    for method in ['by_channel', 'locally_exclusive']:
+        sort_d = st.sortingcomponents.detect_spikes(rec_f, method=method, chunk_size=2000)
+        # time ranges are detected in parallel and merged at their edges
+        sort_dp = st.sortingcomponents.detect_spikes(rec_f, method=method, chunk_size=2000, parallel=True,
+                                                     n_jobs=2, parallel_mode='time')
+        assert list(sort_d.get_unit_ids()) == list(sort_dp.get_unit_ids())
+        for u in sort_d.get_unit_ids():
+            assert np.array_equal(sort_d.get_unit_spike_train(u), sort_dp.get_unit_spike_train(u))
+
+    sort_d = st.sortingcomponents.detect_spikes(rec_f, chunk_size=2000)
+    sort_dc = st.sortingcomponents.detect_spikes(rec_f, chunk_size=2000, parallel=True, n_jobs=2,
+                                                 parallel_mode='channels')
+    for u in sort_d.get_unit_ids():
+        assert np.array_equal(sort_d.get_unit_spike_train(u), sort_dc.get_unit_spike_train(u))
+
+
 if __name__ == '__main__':
-    test_detection()
\ No newline at end of file
+    test_detection()
+    test_detection_chunks()
+    test_detection_alignment()
+    test_detection_interpolation()
+    test_detection_locally_exclusive()
+    test_detection_parallel_time()
\ No newline at end of file
@@ -27,6 +27,22 @@ def check_signal_power_signal1_below_signal2(signals1, signals2, freq_range, fs)
     return below
 
 
+def count_get_traces_calls(recording):
+    '''
+    Replaces get_traces of the recording extractor with a wrapper counting its calls. Returns the list to which an
+    element is appended at each call
+    '''
+    num_calls = []
+    get_traces = recording.get_traces
+
+    def _counted_get_traces(*args, **kwargs):
+        num_calls.append(1)
+        return get_traces(*args, **kwargs)
+
+    recording.get_traces = _counted_get_traces
+    return num_calls
+
+
 def create_wf(min_val=-100, max_val=50, n_samples=100):
     '''
     Creates stereotyped waveform
@@ -79,12 +79,11 @@ class SNR(QualityMetric):
                 seed=seed,
             )
             snr_list = []
+            channel_index = {chan: i for i, chan in enumerate(epoch_recording.get_channel_ids())}
             for i, unit_id in enumerate(self._metric_data._unit_ids):
                 if self._metric_data.verbose:
                     printProgressBar(i + 1, len(self._metric_data._unit_ids))
-                max_channel_idx = epoch_recording.get_channel_ids().index(
-                    max_channels[i]
-                )
+                max_channel_idx = channel_index[max_channels[i]]
                 snr = _compute_template_SNR(
                     templates[i], channel_noise_levels, max_channel_idx
                 )
@@ -153,26 +152,14 @@ def _compute_channel_noise_levels(recording, mode, noise_duration, seed):
     moise_levels: list
         Noise levels for each channel
     """
-    M = recording.get_num_channels()
+    if mode not in ["std", "mad"]:
+        raise Exception("'mode' can be 'std' or 'mad'")
     n_frames = int(noise_duration * recording.get_sampling_frequency())
 
-    if n_frames >= recording.get_num_frames():
-        start_frame = 0
-        end_frame = recording.get_num_frames()
+    # a single random chunk of noise_duration
+    statistics = st.preprocessing.get_recording_statistics(recording, num_chunks=1, chunk_length=n_frames, seed=seed)
+    if mode == "std":
+        noise_levels = statistics.get_std()
     else:
-        start_frame = np.random.RandomState(seed=seed).randint(
-            0, recording.get_num_frames() - n_frames
-        )
-        end_frame = start_frame + n_frames
-
-    X = recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-    noise_levels = []
-    for ch in range(M):
-        if mode == "std":
-            noise_level = np.std(X[ch, :])
-        elif mode == "mad":
-            noise_level = np.median(np.abs(X[ch, :]) / 0.6745)
-        else:
-            raise Exception("'mode' can be 'std' or 'mad'")
-        noise_levels.append(noise_level)
-    return noise_levels
\ No newline at end of file
+        noise_levels = np.median(np.abs(statistics.get_sample()), axis=1) / 0.6745
+    return list(noise_levels)
\ No newline at end of file